@@ -0,0 +1,69 @@
+import json
+import time
+import asyncio
+import argparse
+
+from aiohttp import web
+
+# Заглушка OpenAI-совместимого API для бенчмарков: отвечает на /v1/chat/completions
+# с заданной задержкой, в том числе потоком (stream=True), и считает запросы.
+FAKE_ANSWER = "Это ответ тестового сервера на вопрос пользователя, он нужен только для замеров."
+
+
+class FakeLLM:
+    def __init__(self, latency=0.2, token_delay=0.01, answer=FAKE_ANSWER):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.answer = answer
+        self.requests = 0
+        self.prompt_chars = 0
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat)
+        return app
+
+    async def chat(self, request):
+        body = await request.json()
+        self.requests += 1
+        self.prompt_chars += sum(len(message["content"]) for message in body["messages"])
+        await asyncio.sleep(self.latency)
+        created = int(time.time())
+
+        if not body.get("stream"):
+            return web.json_response({
+                "id": f"fake-{self.requests}", "object": "chat.completion", "created": created,
+                "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": self.answer},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for word in self.answer.split(" "):
+            chunk = {"id": f"fake-{self.requests}", "object": "chat.completion.chunk", "created": created,
+                     "model": body["model"],
+                     "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            await asyncio.sleep(self.token_delay)
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def start(self, host="127.0.0.1", port=0):
+        """Запускает сервер в текущем цикле событий, возвращает (runner, адрес для OPENAI_API_BASE)"""
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return runner, f"http://{host}:{port}/v1"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Заглушка OpenAI API: python -m benchmarks.fake_llm")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--token-delay", type=float, default=0.01)
+    args = parser.parse_args()
+    web.run_app(FakeLLM(args.latency, args.token_delay).app(), host="127.0.0.1", port=args.port)
@@ -0,0 +1,34 @@
+import random
+
+import data_base.utils as db
+from data_base.engine import remove_sessions
+
+WORDS = ("бот база знание каталог заметка проект работа дом учеба код сервер запрос ответ поиск "
+         "рецепт книга фильм задача идея встреча отчет план список адрес телефон пароль настройка "
+         "python sqlite telegram модель промпт индекс дерево путь голос файл архив").split()
+
+
+def make_text(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def make_tree(rng, depth, fanout, notes, note_words):
+    """Дерево каталогов глубины depth с fanout подкаталогами и notes знаниями в каждом: (пути, знания)"""
+    paths, level = [], [()]
+    for _ in range(depth):
+        level = [path + (f"{make_text(rng, 2)} {index}",) for path in level for index in range(fanout)]
+        paths.extend(level)
+    return paths, [(path, make_text(rng, note_words)) for path in paths for _ in range(notes)]
+
+
+async def generate(users=3, depth=3, fanout=5, notes=5, note_words=40, seed=1):
+    """Заполняет базу синтетическими пользователями bench0, bench1, ...; возвращает их id"""
+    rng = random.Random(seed)
+    user_ids = []
+    for index in range(users):
+        user_id = f"bench{index}"
+        paths, values = make_tree(rng, depth, fanout, notes, note_words)
+        await db.import_tree(user_id, "Бенчмарк", paths, iter(values))
+        await remove_sessions()
+        user_ids.append(user_id)
+    return user_ids
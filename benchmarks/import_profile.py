@@ -0,0 +1,59 @@
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+# Отчет о времени импорта: python -m benchmarks.import_profile [модуль]
+# Запускает "python -X importtime -c 'import bot'" в чистом процессе и показывает,
+# какие модули дольше всего загружаются при старте бота или воркера вебхука.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def profile(module):
+    """Возвращает строки (собственное время, накопленное время, глубина, модуль) в микросекундах"""
+    # Отдельная папка с фиктивным .env, чтобы bot.py не создавал .env в репозитории
+    with tempfile.TemporaryDirectory() as workdir:
+        shutil.copy(os.path.join(ROOT, "prompts.json"), workdir)
+        with open(os.path.join(workdir, ".env"), "w") as file:
+            file.write("TOKEN='123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA'\n")
+        env = dict(os.environ, PYTHONPATH=ROOT, DATABASE_URL=f"sqlite+aiosqlite:///{workdir}/profile.db",
+                   LLM_CACHE_DB=os.path.join(workdir, "llm_cache.db"))
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                cwd=workdir, env=env, capture_output=True, text=True)
+    if result.returncode:
+        raise SystemExit(result.stderr)
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(self_time), int(cumulative), (len(name) - len(name.lstrip())) // 2, name.strip()))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Профиль времени импорта при старте")
+    parser.add_argument("module", nargs="?", default="bot")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    rows = profile(args.module)
+    total = max(cumulative for _, cumulative, _, _ in rows)
+    print(f"import {args.module}: {total / 1000:.0f} ms, modules: {len(rows)}\n")
+
+    # Глубина 1 — модули, которые импортирует сам проверяемый модуль
+    print("Прямые импорты, по накопленному времени:")
+    for self_time, cumulative, depth, name in sorted(rows, key=lambda row: -row[1]):
+        if depth == 1:
+            print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    print(f"\nСамые медленные модули по собственному времени (top {args.top}):")
+    for self_time, cumulative, depth, name in sorted(rows, key=lambda row: -row[0])[:args.top]:
+        print(f"  {self_time / 1000:8.1f} ms  {name}")
+
+
+if __name__ == '__main__':
+    main()
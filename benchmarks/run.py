@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+# Бенчмарк горячих путей бота: python -m benchmarks.run (из корня репозитория).
+# База, кэш ответов и индексы создаются во временной папке, LLM заменяется заглушкой,
+# поэтому рабочие данные и .env не затрагиваются. Результаты сравниваются с baselines.json.
+WORKDIR = tempfile.mkdtemp(prefix="bench_")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{WORKDIR}/bench.db"
+os.environ["DB_SHARD_URL"] = f"sqlite+aiosqlite:///{WORKDIR}/bench_{{shard}}.db"
+os.environ["LLM_CACHE_DB"] = os.path.join(WORKDIR, "llm_cache.db")
+os.environ["RETRIEVAL_DIR"] = os.path.join(WORKDIR, "retrieval_index")
+os.environ["OPENAI_TOKEN"] = "bench"
+os.environ.setdefault("GPT_RETRIES", "0")
+
+import openai
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import event
+
+import data_base.utils as db
+from data_base.engine import DB_SHARDS, get_engine, remove_sessions, dispose_engines
+from gpt_util import close_session
+from search import find_answer
+from benchmarks.fake_llm import FakeLLM
+from benchmarks.generate import generate, make_text
+
+BASELINES = os.path.join(os.path.dirname(__file__), "baselines.json")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class QueryCounter:
+    """Считает SQL-запросы, выполненные движками всех шардов"""
+
+    def __init__(self):
+        self.count = 0
+        for shard in range(DB_SHARDS):
+            event.listen(get_engine(shard).sync_engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def percentile(samples, share):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+async def measure(name, operation, repeat, counter, llm):
+    """Выполняет operation(i) repeat раз, каждый раз в новой сессии, как при обработке апдейта"""
+    times, queries, requests = [], [], []
+    for i in range(repeat):
+        counter.count, llm_before = 0, llm.requests
+        start = time.perf_counter()
+        await operation(i)
+        times.append((time.perf_counter() - start) * 1000)
+        queries.append(counter.count)
+        requests.append(llm.requests - llm_before)
+        await remove_sessions()
+    return name, {
+        "p50": round(percentile(times, 0.5), 2),
+        "p95": round(percentile(times, 0.95), 2),
+        "queries": percentile(queries, 0.5),
+        "llm": percentile(requests, 0.5),
+    }
+
+
+async def run(args):
+    command.upgrade(Config(os.path.join(ROOT, "alembic.ini")), "head")
+    llm = FakeLLM(args.llm_latency, args.token_delay)
+    runner, openai.api_base = await llm.start()
+    counter = QueryCounter()
+    rng = random.Random(args.seed)
+
+    users = await generate(args.users, args.depth, args.fanout, args.notes, args.note_words, args.seed)
+    catalogs = {user_id: await db.get_catalog_rows(user_id) for user_id in users}
+    await remove_sessions()
+
+    def random_catalog():
+        user_id = rng.choice(users)
+        return user_id, rng.choice(catalogs[user_id])
+
+    def location(rows, row):
+        names = {item.id: item for item in rows}
+        path = []
+        while row is not None:
+            path.append(row.value)
+            row = names.get(row.parent)
+        return "/".join(reversed(path))
+
+    async def get_tree(i):
+        await db.get_tree(rng.choice(users))
+
+    async def get_path(i):
+        user_id, row = random_catalog()
+        await db.get_path(user_id, row.id)
+
+    async def get_notes(i):
+        user_id, row = random_catalog()
+        await db.get_notes(user_id, row.id)
+
+    async def get_notes_from_location(i):
+        user_id, row = random_catalog()
+        await db.get_notes_from_location(user_id, location(catalogs[user_id], row))
+
+    async def search(i):
+        await find_answer(rng.choice(users), make_text(rng, 6) + "?")
+
+    async def search_stream(i):
+        async def on_chunk(text, from_base):
+            pass
+        await find_answer(rng.choice(users), make_text(rng, 6) + "?", on_chunk=on_chunk)
+
+    # Удаляем каталоги первого уровня со всеми потомками — самый тяжелый случай
+    subtrees = [(user_id, row.id) for user_id in users for row in catalogs[user_id]
+                if row.parent == catalogs[user_id][0].id]
+    rng.shuffle(subtrees)
+
+    async def delete_catalog(i):
+        await db.delete_catalog(*subtrees[i])
+
+    results = [
+        await measure("get_tree", get_tree, args.repeat, counter, llm),
+        await measure("get_path", get_path, args.repeat, counter, llm),
+        await measure("get_notes", get_notes, args.repeat, counter, llm),
+        await measure("get_notes_from_location", get_notes_from_location, args.repeat, counter, llm),
+        await measure("search", search, args.repeat, counter, llm),
+        await measure("search_stream", search_stream, args.repeat, counter, llm),
+        await measure("delete_catalog", delete_catalog, min(args.repeat, len(subtrees)), counter, llm),
+    ]
+
+    await close_session()
+    await runner.cleanup()
+    await dispose_engines()
+    return dict(results)
+
+
+def compare(results, baselines, tolerance):
+    """Печатает таблицу и возвращает число регрессий относительно baselines"""
+    regressions = 0
+    print(f"{'benchmark':<26}{'p50 ms':>10}{'p95 ms':>10}{'queries':>9}{'llm':>5}{'base p95':>10}  status")
+    for name, result in results.items():
+        base = baselines.get(name)
+        status = "new"
+        if base:
+            # Мелкие операции шумят, поэтому к допуску добавляем миллисекунду
+            slower = result["p95"] > base["p95"] * tolerance + 1
+            more_queries = result["queries"] > base["queries"] or result["llm"] > base["llm"]
+            status = "REGRESSION" if slower or more_queries else "ok"
+            regressions += status == "REGRESSION"
+        print(f"{name:<26}{result['p50']:>10}{result['p95']:>10}{result['queries']:>9}{result['llm']:>5}"
+              f"{base['p95'] if base else '-':>10}  {status}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк базы знаний и поиска")
+    parser.add_argument("--users", type=int, default=3)
+    parser.add_argument("--depth", type=int, default=3, help="глубина дерева каталогов")
+    parser.add_argument("--fanout", type=int, default=5, help="подкаталогов в каждом каталоге")
+    parser.add_argument("--notes", type=int, default=5, help="знаний в каждом каталоге")
+    parser.add_argument("--note-words", type=int, default=40, help="слов в знании")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="задержка заглушки LLM, сек")
+    parser.add_argument("--token-delay", type=float, default=0.001)
+    parser.add_argument("--tolerance", type=float, default=1.5, help="допустимый рост p95 относительно базы")
+    parser.add_argument("--save-baseline", action="store_true", help="записать результаты в baselines.json")
+    args = parser.parse_args()
+
+    config = {key: value for key, value in vars(args).items() if key not in ("tolerance", "save_baseline")}
+    results = asyncio.run(run(args))
+
+    stored = {}
+    if os.path.isfile(BASELINES):
+        with open(BASELINES, encoding="utf-8") as file:
+            stored = json.load(file)
+    if stored and stored.get("config") != config:
+        print("Параметры отличаются от тех, с которыми записаны baselines.json, сравнение приблизительное")
+    regressions = compare(results, stored.get("results", {}), args.tolerance)
+
+    if args.save_baseline:
+        with open(BASELINES, "w", encoding="utf-8") as file:
+            json.dump({"config": config, "results": results}, file, ensure_ascii=False, indent=2)
+        print(f"Записано в {BASELINES}")
+    sys.exit(1 if regressions and not args.save_baseline else 0)
+
+
+if __name__ == '__main__':
+    main()
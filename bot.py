@@ -1,22 +1,23 @@
-from aiogram import Bot, types
+import config
+from aiogram import types
 from aiogram.utils import executor
 from aiogram.utils import exceptions as aiogram_exceptions
 from aiogram.dispatcher import Dispatcher, FSMContext
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher.filters.state import StatesGroup, State
-import json
-import speech_recognition as sr
 import os
-import subprocess
-from datetime import datetime
-from imageio_ffmpeg import get_ffmpeg_exe
-from dotenv import load_dotenv
+import tempfile
 import data_base.utils as db
-from gpt_util import chat_gpt_query
+from data_base.engine import DB_SHARDS, get_engine, dispose_engines
+from data_base import archive
+import jobs
+from gpt_util import close_session
+from outbox import QueuedBot
+from fsm_storage import SQLiteStorage
+from middlewares import DatabaseMiddleware, MetricsMiddleware
+from metrics import instrument_engine, start_metrics_server
 
 if os.path.isfile(".env"):
-    load_dotenv()
     TOKEN = os.getenv("TOKEN")
 else:
     with open(".env", "w") as file:
@@ -25,10 +26,6 @@ else:
     print("insert bot token in .env file")
     exit(0)
 
-prompts = {}
-with open("prompts.json", "r", encoding="utf-8") as file:
-    prompts = json.load(file)
-
 nl = "\n"
 
 
@@ -42,119 +39,93 @@ class States(StatesGroup):
     choose_note_to_edit = State()
     add_catalog_voice = State()
     add_note_voice = State()
+    import_archive = State()
 
 
-bot = Bot(token=TOKEN)
-dp = Dispatcher(bot, storage=MemoryStorage())
+# Все исходящие запросы идут через очередь с лимитами Telegram
+bot = QueuedBot(token=TOKEN)
+dp = Dispatcher(bot, storage=SQLiteStorage())
+dp.middleware.setup(DatabaseMiddleware())
+dp.middleware.setup(MetricsMiddleware())
+for shard in range(DB_SHARDS):
+    instrument_engine(get_engine(shard))
 
+BUSY_TEXT = "⏳ У вас уже несколько вопросов в очереди, дождитесь ответов на них"
 
-@dp.message_handler(content_types=[types.ContentType.VOICE],
-                    state=[States.search, States.add_catalog, States.add_note, States.add_catalog_voice,
-                           States.add_note_voice])
-async def voice_message_handler(message: types.Message, state: FSMContext):
-    voice = await message.voice.get_file()
-    file = await bot.download_file(voice.file_path)
 
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    voice_filename = f"voice_{timestamp}.ogg"
-    wav_filename = f"voice_{timestamp}.wav"
+async def enqueue_job(message, kind, payload, accepted_text):
+    """Ставит фоновую задачу и сразу отвечает пользователю; результат пришлет воркер из jobs.py"""
+    try:
+        job_id = await jobs.enqueue(kind, message.from_user.id, message.chat.id, payload)
+    except jobs.JobLimitExceeded:
+        await bot.send_message(message.from_user.id, BUSY_TEXT)
+    else:
+        # Место в общей очереди: задачи выполняют воркеры всех процессов
+        position = (await jobs.get_queue_positions(message.from_user.id)).get(job_id)
+        queued = f", в очереди: позиция {position}" if position else ""
+        await bot.send_message(message.from_user.id, f"{accepted_text} (задача #{job_id}{queued}, статус — /jobs)")
 
-    with open(voice_filename, "wb") as f:
-        f.write(file.getvalue())
 
-    ffmpeg_exe = get_ffmpeg_exe()
-    subprocess.run([ffmpeg_exe, '-i', voice_filename, wav_filename])
+def parse_page(data, prefix):
+    """Разбирает callback вида prefix + "<id>[:>курсор|:<курсор]" в (id, after, before)"""
+    key, _, cursor = data[len(prefix):].partition(":")
+    after = int(cursor[1:]) if cursor.startswith(">") else None
+    before = int(cursor[1:]) if cursor.startswith("<") else None
+    return key, after, before
 
-    recognizer = sr.Recognizer()
-    with sr.AudioFile(wav_filename) as source:
-        audio_data = recognizer.record(source)
-        text = recognizer.recognize_google(audio_data, language="ru-RU")
 
-    os.remove(voice_filename)
-    os.remove(wav_filename)
+def page_buttons(prefix, key, rows, has_prev, has_next):
+    """Кнопки перехода на соседние страницы списка"""
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("◀️", callback_data=f"{prefix}{key}:<{rows[0].id}" if rows
+                                            else f"{prefix}{key}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("▶️", callback_data=f"{prefix}{key}:>{rows[-1].id}"))
+    return buttons
 
-    current_state = await state.get_state()
-    if current_state == States.search.state:
-        await bot.send_message(message.from_user.id, f"Распознанный текст: {text}\nИщу...")
 
-        try:
-            tree = db.get_tree(message.from_user.id)
-            location = chat_gpt_query(prompts["ask_file_location"].format(text, tree))
+def note_preview(row):
+    return row.preview + ("…" if row.length > len(row.preview) else "")
 
-            notes = db.get_notes_from_location(message.from_user.id, location) if location else None
-            has_data = notes and isinstance(notes, list) and len(notes) > 0
 
-            if has_data:
-                answer = chat_gpt_query(prompts["read_file"].format(text, notes))
-                await bot.send_message(
-                    message.from_user.id,
-                    f"📚 Ответ из базы знаний:\n\n{answer}",
-                    parse_mode=None
-                )
-            else:
-                prompt = prompts["generate_answer"].format(text)
-                ai_response = chat_gpt_query(prompt)
-
-                kb = InlineKeyboardMarkup()
-                kb.add(InlineKeyboardButton("💾 Сохранить ответ в базу", callback_data="save_ai_response"))
-
-                await state.update_data(ai_response=ai_response, user_query=text)
+async def notes_page_to_choose(callback_query, state, prefix):
+    """Страница знаний с номерами для выбора; id знаний страницы запоминаются в состоянии"""
+    head_catalog, after, before = parse_page(callback_query.data, prefix)
+    rows, has_prev, has_next = await db.get_notes_page(callback_query.from_user.id, head_catalog, after, before)
+    await state.update_data(page_note_ids=[row.id for row in rows])
 
-                await bot.send_message(
-                    message.from_user.id,
-                    f"🤖 Вот что я знаю:\n\n{ai_response}",
-                    reply_markup=kb,
-                    parse_mode=None
-                )
+    kb = InlineKeyboardMarkup()
+    if buttons := page_buttons(prefix, head_catalog, rows, has_prev, has_next):
+        kb.row(*buttons)
+    return head_catalog, [f"{i}: {note_preview(row)}" for i, row in enumerate(rows)], kb
 
-        except Exception as err:
-            print(f"От: {message.from_user.id}, Запрос: {text}\nОшибка: {err}")
-            await bot.send_message(message.from_user.id, "🔄 Давайте попробуем переформулировать вопрос")
-        finally:
-            await state.finish()
 
-    else:
-        await bot.send_message(message.from_user.id, f"Распознанный текст: {text}")
-
-        user_data = await state.get_data()
-
-        head_catalog_id = user_data.get("head_catalog_id")
-
-        if current_state in ["States:add_catalog", "States:add_catalog_voice"]:
-            if head_catalog_id:
-                db.create_catalog(message.from_user.id, text, head_catalog_id)
-            else:
-                db.create_catalog(message.from_user.id, text)
-            success_message = f"✅ | Каталог '{text}' добавлен!"
-        elif current_state in ["States:add_note", "States:add_note_voice"]:
-            if head_catalog_id:
-                db.create_note(message.from_user.id, head_catalog_id, text)
-                success_message = f"✅ | Знание '{text}' добавлено!"
-            else:
-                await bot.send_message(message.from_user.id,
-                                       f"🗄 | Знание '{text}' не может быть создано тут(\n"
-                                       f"🗄 | Выберите Каталог и создайте знание в нем")
-                await state.finish()
-                return
-
-        exit_kb = InlineKeyboardMarkup().add(InlineKeyboardButton("⬅️", callback_data=user_data.get("last_menu", "")))
-        await bot.send_message(message.from_user.id, success_message, reply_markup=exit_kb)
-        await state.finish()
+@dp.message_handler(content_types=[types.ContentType.VOICE],
+                    state=[States.search, States.add_catalog, States.add_note, States.add_catalog_voice,
+                           States.add_note_voice])
+async def voice_message_handler(message: types.Message, state: FSMContext):
+    user_data = await state.get_data()
+    await enqueue_job(message, "voice", {
+        "file_id": message.voice.file_id,
+        "state": await state.get_state(),
+        "head_catalog_id": user_data.get("head_catalog_id"),
+        "last_menu": user_data.get("last_menu", ""),
+    }, "🎙 Распознаю голосовое сообщение...")
+    await state.finish()
 
 
 @dp.callback_query_handler(lambda c: c.data.startswith('edit_note_'), state='*')
 async def process_edit_note(callback_query: types.CallbackQuery, state: FSMContext):
-    catalog_id = callback_query.data.split('_')[-1]
+    catalog_id, lines, kb = await notes_page_to_choose(callback_query, state, 'edit_note_')
     await state.update_data(editing_catalog_id=catalog_id)
 
-    notes = db.get_notes(callback_query.from_user.id, catalog_id)
+    text = "Выберите номер знания для редактирования:\n" + nl.join(lines)
 
-    text = "Выберите номер знания для редактирования:\n"
-    for i, note in enumerate(notes):
-        text += f"{i}: {note['value'][:30]}...\n"
-
-    await bot.edit_message_text(text, callback_query.from_user.id, callback_query.message.message_id)
+    await bot.edit_message_text(text, callback_query.from_user.id, callback_query.message.message_id,
+                                reply_markup=kb)
     await States.choose_note_to_edit.set()
+    await bot.answer_callback_query(callback_query.id)
 
 
 @dp.message_handler(state=States.choose_note_to_edit)
@@ -162,11 +133,10 @@ async def choose_note_to_edit(message: types.Message, state: FSMContext):
     try:
         note_index = int(message.text)
         user_data = await state.get_data()
-        catalog_id = user_data['editing_catalog_id']
-        notes = db.get_notes(message.from_user.id, catalog_id)
+        note_ids = user_data.get('page_note_ids', [])
 
-        if 0 <= note_index < len(notes):
-            note = notes[note_index]
+        if 0 <= note_index < len(note_ids) and (note := await db.get_note(message.from_user.id,
+                                                                           note_ids[note_index])):
             await state.update_data(editing_note_id=note['id'])
             await bot.send_message(
                 message.from_user.id,
@@ -185,20 +155,25 @@ async def save_edited_note(message: types.Message, state: FSMContext):
     user_data = await state.get_data()
     note_id = user_data['editing_note_id']
     new_text = message.text
-    db.update_note(message.from_user.id, note_id, new_text)
+    await db.update_note(message.from_user.id, note_id, new_text)
     exit_kb = InlineKeyboardMarkup().add(InlineKeyboardButton("⬅️", callback_data=user_data.get("last_menu", "")))
     await bot.send_message(message.from_user.id, "Знание успешно отредактировано!", reply_markup=exit_kb)
     await state.finish()
 
 
-@dp.callback_query_handler(lambda c: c.data == 'save_ai_response', state='*')
+@dp.callback_query_handler(lambda c: c.data.startswith('save_ai_response_'), state='*')
 async def save_ai_response(callback_query: types.CallbackQuery, state: FSMContext):
-    user_data = await state.get_data()
-    ai_response = user_data.get('ai_response')
+    # Ответ ИИ хранится в результате фоновой задачи, id которой записан в кнопке
+    job_id = callback_query.data[len('save_ai_response_'):]
+    result = await jobs.get_job_result(callback_query.from_user.id, int(job_id)) if job_id.isdigit() else {}
+    ai_response = result.get('answer')
+    if not ai_response:
+        await bot.answer_callback_query(callback_query.id, "Ответ уже недоступен")
+        return
 
     # Check if "Ответы ИИ" folder exists, create if not
     ai_folder = None
-    root_catalogs = db.get_root_catalogs(callback_query.from_user.id)
+    root_catalogs = await db.get_root_catalogs(callback_query.from_user.id)
 
     for catalog in root_catalogs:
         if catalog.value == "Ответы ИИ":
@@ -206,10 +181,10 @@ async def save_ai_response(callback_query: types.CallbackQuery, state: FSMContex
             break
 
     if not ai_folder:
-        ai_folder = db.create_catalog(callback_query.from_user.id, "Ответы ИИ")
+        ai_folder = await db.create_catalog(callback_query.from_user.id, "Ответы ИИ")
 
     # Save response in AI folder
-    db.create_note(callback_query.from_user.id, ai_folder.id, ai_response)
+    await db.create_note(callback_query.from_user.id, ai_folder.id, ai_response)
 
     await bot.edit_message_text(
         "✅ Ответ сохранен в папке 'Ответы ИИ'!",
@@ -262,59 +237,72 @@ async def commands(message: types.Message, state: FSMContext):
         await States.search.set()
 
 
-@dp.message_handler(state=States.search)
-async def state_case_met(message: types.Message, state: FSMContext):
-    await bot.send_message(message.from_user.id, "Ищу...")
-    try:
-        tree = db.get_tree(message.from_user.id)
-        location = chat_gpt_query(prompts["ask_file_location"].format(message.text, tree))
-        data = None
+@dp.message_handler(commands=["jobs"], state='*')
+async def jobs_command(message: types.Message, state: FSMContext):
+    rows = await jobs.get_user_jobs(message.from_user.id)
+    if not rows:
+        await bot.send_message(message.from_user.id, "Задач пока нет")
+        return
 
-        if location:
-            data = db.get_notes_from_location(message.from_user.id, location)
+    positions = await jobs.get_queue_positions(message.from_user.id)
+    lines = [f"#{row.id} {jobs.KIND_NAMES.get(row.kind, row.kind)}: {jobs.STATUS_NAMES.get(row.status, row.status)}"
+             + (f", позиция {positions[row.id]}" if row.id in positions else "")
+             + (f", попытка {row.attempts}" if row.attempts > 1 else "") for row in rows]
+    await bot.send_message(message.from_user.id, "Последние задачи:\n" + nl.join(lines))
 
-        if data:
-            # Database response - plain text
-            answer = chat_gpt_query(prompts["read_file"].format(message.text, data))
-            await bot.send_message(
-                message.from_user.id,
-                f"📚 Ответ из базы знаний:\n\n{answer}",
-                parse_mode=None
-            )
-        else:
-            # AI response with formatting and save button
-            prompt = prompts["generate_answer"].format(message.text)
-            ai_response = chat_gpt_query(prompt)
 
-            # Create save button
-            kb = InlineKeyboardMarkup()
-            kb.add(InlineKeyboardButton("💾 Сохранить ответ в базу", callback_data="save_ai_response"))
+@dp.message_handler(commands=["import", "export"], state='*')
+async def archive_commands(message: types.Message, state: FSMContext):
+    await state.finish()
+    if message.get_command() == '/export':
+        await bot.send_message(message.from_user.id, "📦 Собираю архив...")
+        with await archive.export_archive(message.from_user.id) as file:
+            await bot.send_document(message.from_user.id, types.InputFile(file, filename="knowledge.zip"))
+    else:
+        await States.import_archive.set()
+        await bot.send_message(message.from_user.id,
+                               "📥 Пришлите zip-архив с папками и Markdown-файлами или JSON-файл.\n"
+                               "ℹ️ Для отмены действия - /start")
+
+
+@dp.message_handler(content_types=[types.ContentType.DOCUMENT], state=States.import_archive)
+async def import_document(message: types.Message, state: FSMContext):
+    document = message.document
+    if document.file_size and document.file_size > archive.ARCHIVE_MAX_SIZE:
+        await bot.send_message(message.from_user.id, "🚫 | Файл больше 20 МБ, разбейте его на части")
+        return
+
+    await bot.send_message(message.from_user.id, "⏳ Импортирую...")
+    kb = InlineKeyboardMarkup().add(InlineKeyboardButton("📕 Открыть хранилище данных", callback_data='list_catalog_'))
+    # Архив скачивается во временный файл и читается по частям
+    with tempfile.TemporaryFile() as file:
+        await bot.download_file((await document.get_file()).file_path, destination=file)
+        name = os.path.splitext(document.file_name or "")[0] or "Импорт"
+        try:
+            catalogs, notes = await archive.import_archive(message.from_user.id, file, name)
+        except archive.ArchiveError as err:
+            print(f"From: {message.from_user.id}, {document.file_name}\n{err}")
+            await bot.send_message(message.from_user.id, "🚫 | Не получилось прочитать архив, нужен zip или JSON")
+        else:
+            await bot.send_message(message.from_user.id,
+                                   f"✅ | Импортировано в '{name}': каталогов — {catalogs}, знаний — {notes}",
+                                   reply_markup=kb)
+    await state.finish()
 
-            # Save response for later use
-            await state.update_data(ai_response=ai_response, user_query=message.text)
 
-            # Send formatted response with button
-            await bot.send_message(
-                message.from_user.id,
-                f"🤖 Сгенерированный ответ:\n\n{ai_response}",
-                reply_markup=kb,
-                parse_mode=None
-            )
-
-    except Exception as err:
-        print(f"Ошибка: {err}")
-        await bot.send_message(message.from_user.id, "🔄 Давайте попробуем переформулировать вопрос")
-    finally:
-        await state.finish()
+@dp.message_handler(state=States.search)
+async def state_case_met(message: types.Message, state: FSMContext):
+    await enqueue_job(message, "search", {"text": message.text}, "Ищу...")
+    await state.finish()
 
 
 @dp.message_handler(state=States.add_catalog)
 async def state_case_met(message: types.Message, state: FSMContext):
     user_data = await state.get_data()
     if head_catalog_id := user_data["head_catalog_id"]:
-        db.create_catalog(message.from_user.id, message.text, head_catalog_id)
+        await db.create_catalog(message.from_user.id, message.text, head_catalog_id)
     else:
-        db.create_catalog(message.from_user.id, message.text)
+        await db.create_catalog(message.from_user.id, message.text)
 
     exit_kb = InlineKeyboardMarkup().add(InlineKeyboardButton("⬅️", callback_data=user_data["last_menu"]))
     await bot.send_message(message.from_user.id,
@@ -331,7 +319,7 @@ async def state_case_met(message: types.Message, state: FSMContext):
                                f"🗄 | Знание '{message.text}' не может быть создано тут(\n"
                                f"🗄 | Выберите Каталог и создай знание в нем", )
     else:
-        db.create_note(message.from_user.id, head_catalog_id, message.text)
+        await db.create_note(message.from_user.id, head_catalog_id, message.text)
         exit_kb = InlineKeyboardMarkup().add(InlineKeyboardButton("⬅️", callback_data=user_data["last_menu"]))
         await bot.send_message(message.from_user.id,
                                f"✅ | Знание '{message.text}' добавлено!",
@@ -349,7 +337,8 @@ async def state_case_met(message: types.Message, state: FSMContext):
     else:
         kb = InlineKeyboardMarkup().add(InlineKeyboardButton("⬅️", callback_data=f"list_notes_{catalog_id}"))
         try:
-            db.delete_note_pos(user_id=message.from_user.id, catalog_id=catalog_id, note_pos=message.text)
+            note_id = user_data.get("page_note_ids", [])[int(message.text)]
+            await db.delete_note(user_id=message.from_user.id, note_id=note_id)
             await bot.send_message(message.from_user.id,
                                    "✅ | Знание удалено!",
                                    reply_markup=kb)
@@ -366,21 +355,23 @@ async def callback_inline(callback_query: types.CallbackQuery, state: FSMContext
     if str(callback_query.data).startswith('list_catalog_'):
         await state.update_data(last_menu=str(callback_query.data))
         catalogs_kb = InlineKeyboardMarkup()
-        head_catalog = str(callback_query.data).split("_")[-1]
-        catalogs = db.get_child_catalogs(callback_query.from_user.id,
-                                       head_catalog) if head_catalog else db.get_root_catalogs(callback_query.from_user.id)
+        head_catalog, after, before = parse_page(str(callback_query.data), 'list_catalog_')
+        catalogs, has_prev, has_next = await db.get_catalogs_page(callback_query.from_user.id, head_catalog,
+                                                                  after, before)
 
         for catalog in catalogs:
             catalogs_kb.add(InlineKeyboardButton(f"🗂 {catalog.value}", callback_data=f"list_catalog_{catalog.id}"))
+        if buttons := page_buttons('list_catalog_', head_catalog, catalogs, has_prev, has_next):
+            catalogs_kb.row(*buttons)
 
         if head_catalog:
             catalogs_kb.row(InlineKeyboardButton("+🗄 Каталог", callback_data=f"add_catalog_{head_catalog}"),
                            InlineKeyboardButton("+🗒 Знание", callback_data=f"add_note_{head_catalog}"))
-            exit_catalog = db.get_parent_catalog(callback_query.from_user.id, head_catalog)
+            exit_catalog = await db.get_parent_catalog(callback_query.from_user.id, head_catalog)
             catalogs_kb.add(InlineKeyboardButton("📖 Моя база знаний", callback_data=f"list_notes_{head_catalog}"))
             catalogs_kb.add(InlineKeyboardButton("❌ Удалить этот Каталог", callback_data=f"del_catalog_{head_catalog}"))
             catalogs_kb.add(InlineKeyboardButton("⬅️", callback_data=f"list_catalog_{exit_catalog or ''}"))
-            catalog_path = "/" + "/".join(db.get_path(callback_query.from_user.id, head_catalog))
+            catalog_path = "/" + "/".join(await db.get_path(callback_query.from_user.id, head_catalog))
         else:
             catalogs_kb.add(InlineKeyboardButton("+🗄 Каталог", callback_data="add_catalog_"))
             catalog_path = "/"
@@ -403,18 +394,20 @@ async def callback_inline(callback_query: types.CallbackQuery, state: FSMContext
     if str(callback_query.data).startswith('list_notes_'):
         await state.update_data(last_menu=str(callback_query.data))
         notes_kb = InlineKeyboardMarkup()
-        head_catalog = str(callback_query.data).split("_")[-1]
+        head_catalog, after, before = parse_page(str(callback_query.data), 'list_notes_')
 
-        notes = db.get_notes(callback_query.from_user.id, head_catalog)
+        notes, has_prev, has_next = await db.get_notes_page(callback_query.from_user.id, head_catalog, after, before)
 
+        if buttons := page_buttons('list_notes_', head_catalog, notes, has_prev, has_next):
+            notes_kb.row(*buttons)
         notes_kb.add(InlineKeyboardButton("+🗒 Добавить знание", callback_data=f"add_note_{head_catalog}"))
         notes_kb.add(InlineKeyboardButton("✏️ Редактировать знание", callback_data=f"edit_note_{head_catalog}"))
         notes_kb.add(InlineKeyboardButton("❌ Удалить знание", callback_data=f"del_note_{head_catalog}"))
-        exit_catalog = db.get_parent_catalog(callback_query.from_user.id, head_catalog)
+        exit_catalog = await db.get_parent_catalog(callback_query.from_user.id, head_catalog)
         notes_kb.add(InlineKeyboardButton("⬅️", callback_data=f"list_catalog_{exit_catalog}".replace("None", "")))
-        catalog_path = "/" + "/".join(db.get_path(callback_query.from_user.id, head_catalog))
+        catalog_path = "/" + "/".join(await db.get_path(callback_query.from_user.id, head_catalog))
         await bot.edit_message_text(f"📚 Cписок знаний в {catalog_path}:\n"
-                                    f"{nl.join([i['value'] for i in notes])}",
+                                    f"{nl.join(note_preview(note) for note in notes)}",
                                     callback_query.from_user.id,
                                     callback_query.message.message_id,
                                     reply_markup=notes_kb)
@@ -446,7 +439,7 @@ async def callback_inline(callback_query: types.CallbackQuery, state: FSMContext
         if catalog_id := str(callback_query.data).split("_")[-1]:
             kb = InlineKeyboardMarkup().add(InlineKeyboardButton("⬅️", callback_data=f"list_catalog_"))
             try:
-                db.delete_catalog(user_id=callback_query.from_user.id, catalog_id=catalog_id)
+                await db.delete_catalog(user_id=callback_query.from_user.id, catalog_id=catalog_id)
                 await bot.edit_message_text("✅ | Каталог удалён.",
                                             callback_query.from_user.id,
                                             callback_query.message.message_id,
@@ -461,24 +454,36 @@ async def callback_inline(callback_query: types.CallbackQuery, state: FSMContext
     if str(callback_query.data).startswith('del_note_'):
         await States.del_note.set()
         await state.update_data(last_menu=str(callback_query.data))
-        head_catalog = str(callback_query.data).split("_")[-1]
-
-        notes = db.get_notes(callback_query.from_user.id, head_catalog)
+        head_catalog, lines, kb = await notes_page_to_choose(callback_query, state, 'del_note_')
 
-        catalog_path = "/" + "/".join(db.get_path(callback_query.from_user.id, head_catalog))
+        catalog_path = "/" + "/".join(await db.get_path(callback_query.from_user.id, head_catalog))
         text = f"🗄 | Cписок знаний в {catalog_path}:\n"
-        for i in range(len(notes)):
-            text += nl + f"{i}: {notes[i]['value']}"
+        for line in lines:
+            text += nl + line
 
         text += "\n❓ Какое знание вы хотите удалить, введите номер\nℹ️ Для отмены действия - /start"
         await bot.edit_message_text(text,
                                     callback_query.from_user.id,
-                                    callback_query.message.message_id)
+                                    callback_query.message.message_id,
+                                    reply_markup=kb)
 
         await state.update_data(in_catalog=head_catalog)
 
     await bot.answer_callback_query(callback_query.id)
 
 
+async def on_startup(dispatcher: Dispatcher):
+    start_metrics_server()
+
+
+async def on_shutdown(dispatcher: Dispatcher):
+    await close_session()
+    await dispose_engines()
+
+
 if __name__ == '__main__':
-    executor.start_polling(dp)
+    job_workers = jobs.start_workers()
+    try:
+        executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown)
+    finally:
+        jobs.stop_workers(job_workers)
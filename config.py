@@ -0,0 +1,14 @@
+import os
+import json
+
+from dotenv import find_dotenv, load_dotenv
+
+# Настройки загружаются один раз, при первом импорте: переменные из .env (ищется от текущей папки)
+# и промпты. Поэтому config импортируется раньше модулей, которые читают os.getenv при импорте.
+if dotenv_path := find_dotenv(usecwd=True):
+    load_dotenv(dotenv_path)
+
+PROMPTS_PATH = os.getenv("PROMPTS_PATH", "prompts.json")
+
+with open(PROMPTS_PATH, "r", encoding="utf-8") as file:
+    prompts = json.load(file)
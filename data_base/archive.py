@@ -0,0 +1,119 @@
+import os
+import json
+import zlib
+import zipfile
+import tempfile
+import posixpath
+
+from data_base import utils
+
+# Файлы, которые при импорте архива становятся знаниями
+NOTE_EXTENSIONS = (".md", ".markdown", ".txt")
+# Больше Bot API скачать не даст
+ARCHIVE_MAX_SIZE = 20 * 1024 * 1024
+# Файлы больше этого размера (байт) при импорте пропускаются
+ARCHIVE_MAX_NOTE_SIZE = int(os.getenv("ARCHIVE_MAX_NOTE_SIZE", 1024 * 1024))
+# До этого размера выгрузка собирается в памяти, дальше — во временном файле
+EXPORT_SPOOL_SIZE = int(os.getenv("EXPORT_SPOOL_SIZE", 8 * 1024 * 1024))
+
+
+class ArchiveError(ValueError):
+    pass
+
+
+def _is_hidden(parts):
+    # Служебные папки редакторов (.obsidian, __MACOSX и т.п.)
+    return any(part.startswith((".", "__")) for part in parts)
+
+
+def _read_zip(file):
+    """Каталоги — папки архива, знания — текстовые файлы. Содержимое читается по одному файлу"""
+    archive = zipfile.ZipFile(file)
+    dirs, members = set(), []
+    for info in archive.infolist():
+        parts = tuple(part for part in info.filename.split("/") if part)
+        if not parts or _is_hidden(parts):
+            continue
+        if info.is_dir():
+            dirs.add(parts)
+        elif info.filename.lower().endswith(NOTE_EXTENSIONS) and info.file_size <= ARCHIVE_MAX_NOTE_SIZE:
+            dirs.add(parts[:-1])
+            members.append((parts[:-1], info))
+
+    # Если все лежит в одной папке (как при упаковке хранилища целиком), не повторяем ее в дереве
+    tops = {path[0] for path in dirs if path}
+    strip = 1 if len(tops) == 1 and all(path for path, _ in members) else 0
+
+    def notes():
+        with archive:
+            for path, info in members:
+                try:
+                    value = archive.read(info).decode("utf-8", errors="replace").strip()
+                # Битый файл (ошибка CRC, обрезанный архив), неподдерживаемое сжатие или шифрование
+                except (zipfile.BadZipFile, KeyError, EOFError, zlib.error, NotImplementedError, RuntimeError) as err:
+                    raise ArchiveError(f"{info.filename}: {err}")
+                if value:
+                    yield path[strip:], value
+
+    return [path[strip:] for path in dirs if path[strip:]], notes()
+
+
+def _read_json(file):
+    """JSON вида {"name": ..., "notes": [...], "catalogs": [...]} (или список таких каталогов)"""
+    try:
+        data = json.load(file)
+    except (UnicodeDecodeError, json.JSONDecodeError) as err:
+        raise ArchiveError(f"invalid json: {err}")
+
+    if not isinstance(data, (dict, list)):
+        raise ArchiveError(f"root must be an object or a list: {data!r:.50}")
+    dirs, notes = [], []
+    stack = [((), data)] if isinstance(data, dict) else [((), {"catalogs": data})]
+    while stack:
+        path, catalog = stack.pop()
+        values, children = catalog.get("notes", []), catalog.get("catalogs", [])
+        if not isinstance(values, list) or not all(isinstance(value, (str, int, float)) for value in values):
+            raise ArchiveError(f"notes must be a list of strings: {values!r:.50}")
+        if not isinstance(children, list) or not all(isinstance(child, dict) for child in children):
+            raise ArchiveError(f"catalogs must be a list of objects: {children!r:.50}")
+        if path:
+            dirs.append(path)
+        notes.extend((path, str(value).strip()) for value in values if str(value).strip())
+        stack.extend((path + (str(child.get("name") or "Без названия"),), child) for child in children)
+    return dirs, iter(notes)
+
+
+def read_archive(file):
+    """Разбирает zip с Markdown-файлами или JSON: возвращает (пути каталогов, итератор (путь, текст))"""
+    if zipfile.is_zipfile(file):
+        file.seek(0)
+        try:
+            return _read_zip(file)
+        except zipfile.BadZipFile as err:
+            raise ArchiveError(str(err))
+    file.seek(0)
+    return _read_json(file)
+
+
+async def import_archive(user_id, file, name):
+    """Импортирует архив в новый корневой каталог name, возвращает (число каталогов, число знаний)"""
+    catalog_paths, notes = read_archive(file)
+    return await utils.import_tree(user_id, name, catalog_paths, notes)
+
+
+def _safe_name(name):
+    return name.replace("/", "_").replace("\\", "_").strip() or "_"
+
+
+async def export_archive(user_id):
+    """Выгружает базу знаний в zip (папки — каталоги, файлы <id>.md — знания), возвращает файл с начала"""
+    paths, notes = await utils.export_tree(user_id)
+    file = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+    with zipfile.ZipFile(file, "w", zipfile.ZIP_DEFLATED) as archive:
+        # Пустые каталоги тоже сохраняем, чтобы дерево вернулось при импорте целиком
+        for path in sorted(paths.values()):
+            archive.writestr(posixpath.join(*map(_safe_name, path)) + "/", "")
+        async for path, note_id, value in notes:
+            archive.writestr(posixpath.join(*map(_safe_name, path), f"{note_id}.md"), value)
+    file.seek(0)
+    return file
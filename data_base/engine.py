@@ -0,0 +1,81 @@
+import os
+from asyncio import current_task
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, async_scoped_session
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///data.db")
+DB_ECHO = os.getenv("DB_ECHO", "0") == "1"
+# Каталоги и знания пользователей разнесены по DB_SHARDS базам (см. data_base/router.py).
+# Шард 0 — основная база DATABASE_URL, в ней же общие таблицы (FSM, задачи, справочник шардов);
+# адреса остальных шардов строятся по шаблону DB_SHARD_URL
+DB_SHARDS = int(os.getenv("DB_SHARDS", 1))
+DB_SHARD_URL = os.getenv("DB_SHARD_URL", "sqlite+aiosqlite:///data_{shard}.db")
+
+# Настройки SQLite: WAL позволяет читать параллельно с записью,
+# synchronous=NORMAL в режиме WAL не теряет согласованность при сбое
+SQLITE_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=134217728",
+]
+
+
+def shard_url(shard):
+    return DATABASE_URL if shard == 0 else DB_SHARD_URL.format(shard=shard)
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def _create_engine(url):
+    shard_engine = create_async_engine(url, echo=DB_ECHO)
+    event.listen(shard_engine.sync_engine, "connect", _set_sqlite_pragmas)
+    return shard_engine
+
+
+# Основная база: один движок на процесс
+engine = _create_engine(DATABASE_URL)
+
+Session = async_sessionmaker(engine, expire_on_commit=False)
+# Своя сессия у каждой asyncio-задачи, то есть у каждого обрабатываемого апдейта.
+# После обработки ее нужно закрыть через session.remove()
+session = async_scoped_session(Session, scopefunc=current_task)
+
+# У каждого шарда свой движок со своим пулом соединений и своя сессия на задачу: shard -> (engine, session)
+_shards = {0: (engine, session)}
+
+
+def _get_shard(shard):
+    if shard not in _shards:
+        shard_engine = _create_engine(shard_url(shard))
+        _shards[shard] = (shard_engine, async_scoped_session(async_sessionmaker(shard_engine, expire_on_commit=False),
+                                                             scopefunc=current_task))
+    return _shards[shard]
+
+
+def get_engine(shard=0):
+    return _get_shard(shard)[0]
+
+
+def get_shard_session(shard=0):
+    """Сессия текущей задачи в базе шарда"""
+    return _get_shard(shard)[1]()
+
+
+async def remove_sessions():
+    """Закрывает сессии текущей задачи во всех шардах"""
+    for _, shard_session in list(_shards.values()):
+        await shard_session.remove()
+
+
+async def dispose_engines():
+    for shard_engine, _ in list(_shards.values()):
+        await shard_engine.dispose()
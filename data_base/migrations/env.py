@@ -0,0 +1,41 @@
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import create_engine
+
+import config  # noqa: F401 - DATABASE_URL и шарды могут быть заданы в .env
+from data_base.engine import DB_SHARDS, shard_url
+from data_base.models import Base
+
+if context.config.config_file_name is not None:
+    fileConfig(context.config.config_file_name)
+
+# Миграции применяются к каждому шарду (шард 0 — основная база). Номер шарда передается в
+# config.attributes["shard"]: общие таблицы (fsm_state, job, user_shard) создаются только в основной базе.
+# Миграции выполняются синхронно, поэтому убираем асинхронный драйвер из адреса
+DATABASE_URLS = [shard_url(shard).replace("+aiosqlite", "") for shard in range(DB_SHARDS)]
+
+
+def run_migrations_offline():
+    for shard, url in enumerate(DATABASE_URLS):
+        context.config.attributes["shard"] = shard
+        context.configure(url=url, target_metadata=Base.metadata, literal_binds=True, render_as_batch=True)
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+def run_migrations_online():
+    for shard, url in enumerate(DATABASE_URLS):
+        context.config.attributes["shard"] = shard
+        engine = create_engine(url)
+        with engine.connect() as connection:
+            context.configure(connection=connection, target_metadata=Base.metadata, render_as_batch=True)
+            with context.begin_transaction():
+                context.run_migrations()
+        engine.dispose()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,50 @@
+"""Начальная схема: каталоги и знания
+
+Базы, созданные раньше через Base.metadata.create_all, уже содержат эти таблицы —
+тогда создаются только недостающие таблицы и колонки.
+
+Revision ID: 0001
+Revises:
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    tables = inspector.get_table_names()
+
+    if 'catalog' not in tables:
+        op.create_table(
+            'catalog',
+            sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+            sa.Column('user_id', sa.String(), nullable=False),
+            sa.Column('value', sa.String(), nullable=False),
+            sa.Column('parent', sa.Integer(), sa.ForeignKey('catalog.id'), nullable=True),
+        )
+
+    if 'note' not in tables:
+        op.create_table(
+            'note',
+            sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+            sa.Column('user_id', sa.String(), nullable=False),
+            sa.Column('value', sa.String(), nullable=False),
+            sa.Column('catalog', sa.Integer(), sa.ForeignKey('catalog.id'), nullable=True),
+        )
+    else:
+        columns = {column['name'] for column in inspector.get_columns('note')}
+        with op.batch_alter_table('note') as batch_op:
+            if 'user_id' not in columns:
+                batch_op.add_column(sa.Column('user_id', sa.String(), nullable=False, server_default=''))
+            if 'catalog' not in columns:
+                batch_op.add_column(sa.Column('catalog', sa.Integer(), sa.ForeignKey('catalog.id'), nullable=True))
+
+
+def downgrade():
+    op.drop_table('note')
+    op.drop_table('catalog')
@@ -0,0 +1,34 @@
+"""Материализованные пути каталогов
+
+Revision ID: 0002
+Revises: 0001
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    columns = {column['name'] for column in sa.inspect(op.get_bind()).get_columns('catalog')}
+    if 'path' not in columns:
+        op.add_column('catalog', sa.Column('path', sa.String(), nullable=True))
+    # Заполняем пути существующих каталогов одним рекурсивным запросом
+    op.execute("""
+        WITH RECURSIVE tree(id, path) AS (
+            SELECT id, '/' || id || '/' FROM catalog WHERE parent IS NULL
+            UNION ALL
+            SELECT catalog.id, tree.path || catalog.id || '/' FROM catalog JOIN tree ON catalog.parent = tree.id
+        )
+        UPDATE catalog SET path = (SELECT tree.path FROM tree WHERE tree.id = catalog.id)
+        WHERE path IS NULL
+    """)
+    op.create_index('ix_catalog_path', 'catalog', ['path'], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_catalog_path', 'catalog')
+    op.drop_column('catalog', 'path')
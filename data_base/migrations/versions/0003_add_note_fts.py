@@ -0,0 +1,35 @@
+"""Полнотекстовый индекс знаний (FTS5)
+
+Revision ID: 0003
+Revises: 0002
+"""
+from alembic import op
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("CREATE VIRTUAL TABLE IF NOT EXISTS note_fts USING fts5("
+               "value, user_id, content='note', content_rowid='id', "
+               "tokenize='unicode61 remove_diacritics 2', prefix='3 4')")
+    op.execute("CREATE TRIGGER IF NOT EXISTS note_fts_ai AFTER INSERT ON note BEGIN "
+               "INSERT INTO note_fts(rowid, value, user_id) VALUES (new.id, new.value, new.user_id); END")
+    op.execute("CREATE TRIGGER IF NOT EXISTS note_fts_ad AFTER DELETE ON note BEGIN "
+               "INSERT INTO note_fts(note_fts, rowid, value, user_id) "
+               "VALUES ('delete', old.id, old.value, old.user_id); END")
+    op.execute("CREATE TRIGGER IF NOT EXISTS note_fts_au AFTER UPDATE ON note BEGIN "
+               "INSERT INTO note_fts(note_fts, rowid, value, user_id) "
+               "VALUES ('delete', old.id, old.value, old.user_id); "
+               "INSERT INTO note_fts(rowid, value, user_id) VALUES (new.id, new.value, new.user_id); END")
+    # Индексируем уже существующие знания
+    op.execute("INSERT INTO note_fts(note_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    op.execute("DROP TRIGGER IF EXISTS note_fts_au")
+    op.execute("DROP TRIGGER IF EXISTS note_fts_ad")
+    op.execute("DROP TRIGGER IF EXISTS note_fts_ai")
+    op.execute("DROP TABLE IF EXISTS note_fts")
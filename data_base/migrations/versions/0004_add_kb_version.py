@@ -0,0 +1,26 @@
+"""Версии баз знаний пользователей (для кэша ответов LLM)
+
+Revision ID: 0004
+Revises: 0003
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if 'kb_version' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        'kb_version',
+        sa.Column('user_id', sa.String(), primary_key=True),
+        sa.Column('version', sa.Integer(), nullable=False, server_default='0'),
+    )
+
+
+def downgrade():
+    op.drop_table('kb_version')
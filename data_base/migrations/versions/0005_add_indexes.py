@@ -0,0 +1,24 @@
+"""Индексы под запросы навигации и поиска
+
+Revision ID: 0005
+Revises: 0004
+"""
+from alembic import op
+
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_catalog_user_id_parent', 'catalog', ['user_id', 'parent'], if_not_exists=True)
+    op.create_index('ix_note_catalog_user_id', 'note', ['catalog', 'user_id'], if_not_exists=True)
+    op.create_index('ix_note_user_id', 'note', ['user_id'], if_not_exists=True)
+    op.execute("ANALYZE")
+
+
+def downgrade():
+    op.drop_index('ix_note_user_id', 'note')
+    op.drop_index('ix_note_catalog_user_id', 'note')
+    op.drop_index('ix_catalog_user_id_parent', 'catalog')
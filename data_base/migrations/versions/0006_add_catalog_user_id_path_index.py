@@ -0,0 +1,20 @@
+"""Индекс для выборки поддерева каталогов пользователя по диапазону путей
+
+Revision ID: 0006
+Revises: 0005
+"""
+from alembic import op
+
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_catalog_user_id_path', 'catalog', ['user_id', 'path'], if_not_exists=True)
+    op.execute("ANALYZE")
+
+
+def downgrade():
+    op.drop_index('ix_catalog_user_id_path', 'catalog')
@@ -0,0 +1,35 @@
+"""Хранилище состояний диалогов (FSM)
+
+Revision ID: 0007
+Revises: 0006
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Общая таблица, она нужна только в основной базе (шард 0)
+    if context.config.attributes.get("shard", 0):
+        return
+    op.create_table(
+        'fsm_state',
+        sa.Column('chat', sa.String(), primary_key=True),
+        sa.Column('user', sa.String(), primary_key=True),
+        sa.Column('state', sa.String(), nullable=True),
+        sa.Column('data', sa.Text(), nullable=False, server_default='{}'),
+        sa.Column('bucket', sa.Text(), nullable=False, server_default='{}'),
+        sa.Column('updated_at', sa.Float(), nullable=False),
+    )
+    op.create_index('ix_fsm_state_updated_at', 'fsm_state', ['updated_at'])
+
+
+def downgrade():
+    if context.config.attributes.get("shard", 0):
+        return
+    op.drop_index('ix_fsm_state_updated_at', 'fsm_state')
+    op.drop_table('fsm_state')
@@ -0,0 +1,45 @@
+"""Очередь фоновых задач
+
+Revision ID: 0008
+Revises: 0007
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Общая таблица, она нужна только в основной базе (шард 0)
+    if context.config.attributes.get("shard", 0):
+        return
+    op.create_table(
+        'job',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('kind', sa.String(), nullable=False),
+        sa.Column('user_id', sa.String(), nullable=False),
+        sa.Column('chat_id', sa.String(), nullable=False),
+        sa.Column('payload', sa.Text(), nullable=False, server_default='{}'),
+        sa.Column('status', sa.String(), nullable=False, server_default='queued'),
+        sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('run_at', sa.Float(), nullable=False),
+        sa.Column('locked_until', sa.Float(), nullable=True),
+        sa.Column('worker', sa.String(), nullable=True),
+        sa.Column('result', sa.Text(), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.Float(), nullable=False),
+        sa.Column('updated_at', sa.Float(), nullable=False),
+    )
+    op.create_index('ix_job_status_run_at', 'job', ['status', 'run_at'])
+    op.create_index('ix_job_user_id_id', 'job', ['user_id', 'id'])
+
+
+def downgrade():
+    if context.config.attributes.get("shard", 0):
+        return
+    op.drop_index('ix_job_user_id_id', 'job')
+    op.drop_index('ix_job_status_run_at', 'job')
+    op.drop_table('job')
@@ -0,0 +1,33 @@
+"""Справочник шардов пользователей
+
+Revision ID: 0009
+Revises: 0008
+"""
+from alembic import context, op
+import sqlalchemy as sa
+
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Общая таблица, она нужна только в основной базе (шард 0)
+    if context.config.attributes.get("shard", 0):
+        return
+    op.create_table(
+        'user_shard',
+        sa.Column('user_id', sa.String(), primary_key=True),
+        sa.Column('shard', sa.Integer(), nullable=False),
+    )
+    # До шардирования все данные лежали в основной базе: закрепляем существующих пользователей за шардом 0
+    op.execute("INSERT INTO user_shard (user_id, shard) "
+               "SELECT user_id, 0 FROM catalog UNION SELECT user_id, 0 FROM note "
+               "UNION SELECT user_id, 0 FROM kb_version")
+
+
+def downgrade():
+    if context.config.attributes.get("shard", 0):
+        return
+    op.drop_table('user_shard')
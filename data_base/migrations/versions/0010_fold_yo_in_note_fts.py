@@ -0,0 +1,55 @@
+"""Полнотекстовый индекс без различия е/ё
+
+Revision ID: 0010
+Revises: 0009
+"""
+from alembic import op
+
+revision = '0010'
+down_revision = '0009'
+branch_labels = None
+depends_on = None
+
+# Индекс хранит текст с заменой ё -> е, поэтому таблица становится contentless:
+# 'rebuild' для нее недоступен, индекс заполняем вставкой из note
+VALUE = "replace(replace({}.value, 'ё', 'е'), 'Ё', 'Е')"
+
+
+def _drop():
+    op.execute("DROP TRIGGER IF EXISTS note_fts_au")
+    op.execute("DROP TRIGGER IF EXISTS note_fts_ad")
+    op.execute("DROP TRIGGER IF EXISTS note_fts_ai")
+    op.execute("DROP TABLE IF EXISTS note_fts")
+
+
+def upgrade():
+    _drop()
+    op.execute("CREATE VIRTUAL TABLE note_fts USING fts5("
+               "value, user_id, content='', tokenize='unicode61 remove_diacritics 2', prefix='3 4')")
+    op.execute("CREATE TRIGGER note_fts_ai AFTER INSERT ON note BEGIN "
+               f"INSERT INTO note_fts(rowid, value, user_id) VALUES (new.id, {VALUE.format('new')}, new.user_id); END")
+    op.execute("CREATE TRIGGER note_fts_ad AFTER DELETE ON note BEGIN "
+               "INSERT INTO note_fts(note_fts, rowid, value, user_id) "
+               f"VALUES ('delete', old.id, {VALUE.format('old')}, old.user_id); END")
+    op.execute("CREATE TRIGGER note_fts_au AFTER UPDATE ON note BEGIN "
+               "INSERT INTO note_fts(note_fts, rowid, value, user_id) "
+               f"VALUES ('delete', old.id, {VALUE.format('old')}, old.user_id); "
+               f"INSERT INTO note_fts(rowid, value, user_id) VALUES (new.id, {VALUE.format('new')}, new.user_id); END")
+    op.execute(f"INSERT INTO note_fts(rowid, value, user_id) SELECT id, {VALUE.format('note')}, user_id FROM note")
+
+
+def downgrade():
+    _drop()
+    op.execute("CREATE VIRTUAL TABLE note_fts USING fts5("
+               "value, user_id, content='note', content_rowid='id', "
+               "tokenize='unicode61 remove_diacritics 2', prefix='3 4')")
+    op.execute("CREATE TRIGGER note_fts_ai AFTER INSERT ON note BEGIN "
+               "INSERT INTO note_fts(rowid, value, user_id) VALUES (new.id, new.value, new.user_id); END")
+    op.execute("CREATE TRIGGER note_fts_ad AFTER DELETE ON note BEGIN "
+               "INSERT INTO note_fts(note_fts, rowid, value, user_id) "
+               "VALUES ('delete', old.id, old.value, old.user_id); END")
+    op.execute("CREATE TRIGGER note_fts_au AFTER UPDATE ON note BEGIN "
+               "INSERT INTO note_fts(note_fts, rowid, value, user_id) "
+               "VALUES ('delete', old.id, old.value, old.user_id); "
+               "INSERT INTO note_fts(rowid, value, user_id) VALUES (new.id, new.value, new.user_id); END")
+    op.execute("INSERT INTO note_fts(note_fts) VALUES ('rebuild')")
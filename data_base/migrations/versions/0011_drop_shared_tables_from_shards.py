@@ -0,0 +1,27 @@
+"""Общие таблицы только в основной базе
+
+Revision ID: 0011
+Revises: 0010
+"""
+from alembic import context, op
+
+revision = '0011'
+down_revision = '0010'
+branch_labels = None
+depends_on = None
+
+# Раньше 0007–0009 создавали fsm_state, job и user_shard в каждом шарде. Их читают только
+# из основной базы, а устаревшая копия справочника шардов могла бы запутать маршрутизацию
+SHARED_TABLES = ("fsm_state", "job", "user_shard")
+
+
+def upgrade():
+    if not context.config.attributes.get("shard", 0):
+        return
+    for table in SHARED_TABLES:
+        op.execute(f"DROP TABLE IF EXISTS {table}")
+
+
+def downgrade():
+    # Копии таблиц в шардах не нужны, 0007–0009 при откате в шардах их тоже не трогают
+    pass
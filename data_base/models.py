@@ -1,17 +1,9 @@
-from typing import List
-
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, select, Table, delete
+from sqlalchemy import Column, Integer, String, Float, Text, ForeignKey, Index, event, DDL
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import mapped_column, relationship, Mapped
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import mapped_column
 
-# Создаем подключение к базе данных
-engine = create_engine('sqlite:///data.db', echo=True)
 Base = declarative_base()
 
-Session = sessionmaker(bind=engine)
-session = Session()
-
 
 # Определяем класс catalog
 class Catalog(Base):
@@ -21,12 +13,16 @@ class Catalog(Base):
     user_id = Column(String, nullable=False)
     value = Column(String, nullable=False)
     parent = mapped_column(ForeignKey(f"{__tablename__}.id"), nullable=True)
+    # Материализованный путь из id предков и самого каталога: "/1/5/9/"
+    path = Column(String, nullable=True, index=True)
 
-    def get_childs(self):
-        return session.scalars(select(catalog).filter_by(parent=self.id)).fetchall()
+    __table_args__ = (
+        Index('ix_catalog_user_id_parent', 'user_id', 'parent'),
+        Index('ix_catalog_user_id_path', 'user_id', 'path'),
+    )
 
-    def get_notes(self):
-        return session.scalars(select(Note).filter_by(catalog=self.id)).fetchall()
+    def path_ids(self):
+        return [int(i) for i in self.path.split("/") if i]
 
     def to_dict(self):
         return {
@@ -34,26 +30,6 @@ class Catalog(Base):
             "id": self.id,
         }
 
-    def tree(self, indent=2):
-        data = []
-        childs = self.get_childs()
-        data.append(f'{" " * indent}{self.value}{"/" if len(childs) else ""}\n')
-        for i in childs:
-            data.append(i.tree(indent + 2))
-            # data.append(f'{" "*indent}{i.tree(indent+2)}\n')
-        return "".join(data)
-
-    def delete(self):
-        for child in self.get_childs():
-            child.delete()
-
-        for notes in self.get_notes():
-            notes.delete()
-
-        catalog = session.scalars(select(catalog).where(catalog.id == self.id)).first()
-        session.delete(catalog)
-        session.commit()
-
 
 class Note(Base):
     __tablename__ = 'note'
@@ -62,10 +38,14 @@ class Note(Base):
     value = Column(String, nullable=False)
     catalog = Column(Integer, ForeignKey('catalog.id'), nullable=True)  # Add this line
 
-    def delete(self):
-        note = session.scalars(select(Note).where(Note.id == self.id)).first()
-        session.delete(note)
-        session.commit()
+    __table_args__ = (
+        Index('ix_note_catalog_user_id', 'catalog', 'user_id'),
+        Index('ix_note_user_id', 'user_id'),
+    )
+
+    async def delete(self, session):
+        """Помечает знание на удаление; транзакцию фиксирует вызывающий код"""
+        await session.delete(self)
 
     def to_dict(self):
         return {
@@ -74,45 +54,75 @@ class Note(Base):
         }
 
 
+class KnowledgeVersion(Base):
+    """Версия базы знаний пользователя, растет при каждом изменении каталогов и знаний"""
+    __tablename__ = 'kb_version'
+    user_id = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+class UserShard(Base):
+    """Справочник шардов: в какой базе лежат каталоги и знания пользователя (только в основной базе)"""
+    __tablename__ = 'user_shard'
+    user_id = Column(String, primary_key=True)
+    shard = Column(Integer, nullable=False)
+
+
+class FsmRecord(Base):
+    """Состояние диалога пользователя (FSM aiogram), сохраняется между перезапусками"""
+    __tablename__ = 'fsm_state'
+    chat = Column(String, primary_key=True)
+    user = Column(String, primary_key=True)
+    state = Column(String, nullable=True)
+    data = Column(Text, nullable=False, default='{}')
+    bucket = Column(Text, nullable=False, default='{}')
+    updated_at = Column(Float, nullable=False, index=True)
+
+
+class Job(Base):
+    """Фоновая задача (голосовое сообщение, поиск ответа), ее выполняют процессы из jobs.py"""
+    __tablename__ = 'job'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(String, nullable=False)
+    user_id = Column(String, nullable=False)
+    chat_id = Column(String, nullable=False)
+    payload = Column(Text, nullable=False, default='{}')
+    # queued -> running -> done | failed; после ошибки задача снова становится queued до исчерпания попыток
+    status = Column(String, nullable=False, default='queued')
+    attempts = Column(Integer, nullable=False, default=0)
+    run_at = Column(Float, nullable=False)
+    # Пока воркер работает, он продлевает аренду; задачу упавшего воркера заберет другой
+    locked_until = Column(Float, nullable=True)
+    worker = Column(String, nullable=True)
+    result = Column(Text, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index('ix_job_status_run_at', 'status', 'run_at'),
+        Index('ix_job_user_id_id', 'user_id', 'id'),
+    )
+
+
+# Полнотекстовый индекс знаний (FTS5), синхронизируется с таблицей note триггерами.
+# unicode61 приводит кириллицу к нижнему регистру, но ё не складывает в е (это не диакритика
+# в Unicode), поэтому индексируем текст с заменой ё -> е. Таблица без содержимого (content=''):
+# нормализованный текст хранится только в индексе, а 'delete' получает то же выражение, что и вставка
+NOTE_FTS_VALUE = "replace(replace({}.value, 'ё', 'е'), 'Ё', 'Е')"
+NOTE_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS note_fts USING fts5("
+    "value, user_id, content='', tokenize='unicode61 remove_diacritics 2', prefix='3 4')",
+    "CREATE TRIGGER IF NOT EXISTS note_fts_ai AFTER INSERT ON note BEGIN "
+    f"INSERT INTO note_fts(rowid, value, user_id) VALUES (new.id, {NOTE_FTS_VALUE.format('new')}, new.user_id); END",
+    "CREATE TRIGGER IF NOT EXISTS note_fts_ad AFTER DELETE ON note BEGIN "
+    "INSERT INTO note_fts(note_fts, rowid, value, user_id) "
+    f"VALUES ('delete', old.id, {NOTE_FTS_VALUE.format('old')}, old.user_id); END",
+    "CREATE TRIGGER IF NOT EXISTS note_fts_au AFTER UPDATE ON note BEGIN "
+    "INSERT INTO note_fts(note_fts, rowid, value, user_id) "
+    f"VALUES ('delete', old.id, {NOTE_FTS_VALUE.format('old')}, old.user_id); "
+    f"INSERT INTO note_fts(rowid, value, user_id) VALUES (new.id, {NOTE_FTS_VALUE.format('new')}, new.user_id); END",
+]
+for statement in NOTE_FTS_DDL:
+    event.listen(Note.__table__, "after_create", DDL(statement))
 
-try:
-    Base.metadata.create_all(bind=engine)
-except:
-    pass
-
-if __name__ == '__main__':
-    catalog1 = catalog(value='Value 1', user_id="12")
-    session.add(catalog1)
-    session.commit()
-
-    catalog2 = catalog(value='Value 2', user_id="12", parent=catalog1.id)
-    session.add(catalog2)
-    session.commit()
-
-    catalog3 = catalog(value='Value 3', user_id="12", parent=catalog2.id)
-    session.add(catalog3)
-    session.commit()
-
-    catalog4 = catalog(value='Value 4', user_id="12", parent=catalog1.id)
-    session.add(catalog4)
-    session.commit()
-
-    catalog5 = catalog(value='Value 5', user_id="12", parent=catalog4.id)
-    session.add(catalog5)
-    session.commit()
-    #
-    note1 = Note(value='Value 1', catalog=catalog4.id)
-    session.add(note1)
-    session.commit()
-
-    note2 = Note(value='Value 2', catalog=catalog4.id)
-    session.add(note2)
-    session.commit()
-
-    # catalog1 = catalog(value='Value 1')
-    # session.add(catalog1)
-    # session.commit()
-    #
-    # catalog2 = catalog(value='Value 2', parent=catalog1.id)
-    # session.add(catalog2)
-    # session.commit()
@@ -0,0 +1,271 @@
+import os
+import re
+import json
+import zlib
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Локальный поиск знаний без LLM: хешированный TF-IDF.
+# Индекс пользователя хранится как три массива NumPy одинаковой длины —
+# (id знания, хеш слова, число вхождений) — и меняется по одному знанию.
+# На диске: снимок <user_id>.npz и журнал изменений <user_id>.log (JSON по строке на изменение);
+# изменение дописывается в журнал, а снимок перезаписывается, когда журнал вырастет до RETRIEVAL_LOG_LIMIT.
+# Индекс помечен версией базы знаний пользователя (kb_version): каждое повышение версии попадает
+# в журнал, поэтому процесс, у которого версия в памяти отстала от базы, перечитывает индекс с диска.
+# Чтение и изменение файлов идут под файловой блокировкой пользователя, общей для всех процессов.
+# Функции модуля синхронные и работают с диском: из асинхронного кода их вызывают через asyncio.to_thread
+RETRIEVAL_DIR = os.getenv("RETRIEVAL_DIR", "retrieval_index")
+RETRIEVAL_DIM = 2 ** 18
+RETRIEVAL_MIN_SCORE = float(os.getenv("RETRIEVAL_MIN_SCORE", 0.15))
+# Сколько индексов пользователей держать в памяти
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", 256))
+# Размер журнала изменений (байт), после которого он сворачивается в новый снимок
+RETRIEVAL_LOG_LIMIT = int(os.getenv("RETRIEVAL_LOG_LIMIT", 1024 * 1024))
+
+_indexes = OrderedDict()
+_lock = threading.Lock()
+
+
+def tokenize(text):
+    """Разбивает текст на слова и грубо отрезает окончания (для русского языка)"""
+    words = re.findall(r"\w+", text.lower().replace("ё", "е"))
+    return [word[:-2] if len(word) > 5 else word for word in words if len(word) > 1]
+
+
+def _vectorize(text):
+    buckets = np.array([zlib.crc32(token.encode()) % RETRIEVAL_DIM for token in tokenize(text)], dtype=np.int32)
+    return np.unique(buckets, return_counts=True)
+
+
+class UserIndex:
+    """Индекс не меняется на месте: add/remove/update возвращают новый, поэтому поиск
+    в другом потоке всегда видит согласованные массивы
+    """
+
+    def __init__(self, note_ids=None, buckets=None, counts=None, version=0):
+        self.note_ids = note_ids if note_ids is not None else np.empty(0, dtype=np.int64)
+        self.buckets = buckets if buckets is not None else np.empty(0, dtype=np.int32)
+        self.counts = counts if counts is not None else np.empty(0, dtype=np.float32)
+        self.version = version
+
+    @classmethod
+    def build(cls, notes, version=0):
+        """Строит индекс по списку (id, текст) за одну склейку массивов"""
+        parts = [(note_id, *_vectorize(text)) for note_id, text in notes]
+        if not parts:
+            return cls(version=version)
+        return cls(np.concatenate([np.full(len(buckets), note_id, dtype=np.int64) for note_id, buckets, _ in parts]),
+                   np.concatenate([buckets for _, buckets, _ in parts]).astype(np.int32),
+                   np.concatenate([counts for _, _, counts in parts]).astype(np.float32),
+                   version)
+
+    def add(self, note_id, text):
+        buckets, counts = _vectorize(text)
+        return UserIndex(np.concatenate([self.note_ids, np.full(len(buckets), note_id, dtype=np.int64)]),
+                         np.concatenate([self.buckets, buckets]),
+                         np.concatenate([self.counts, counts.astype(np.float32)]),
+                         self.version)
+
+    def remove(self, note_ids):
+        keep = ~np.isin(self.note_ids, list(note_ids))
+        return UserIndex(self.note_ids[keep], self.buckets[keep], self.counts[keep], self.version)
+
+    def update(self, note_id, text):
+        return self.remove([note_id]).add(note_id, text)
+
+    def apply(self, change):
+        """Применяет запись журнала: {"version": v} и, если менялись знания, "remove": [id, ...]
+        или "id" и "text"
+        """
+        if "remove" in change:
+            index = self.remove(change["remove"])
+        elif "id" in change:
+            index = self.update(change["id"], change["text"])
+        else:
+            index = UserIndex(self.note_ids, self.buckets, self.counts)
+        index.version = change["version"]
+        return index
+
+    def search(self, query, limit=5, min_score=RETRIEVAL_MIN_SCORE):
+        """Возвращает id знаний, наиболее похожих на запрос (косинус TF-IDF)"""
+        query_buckets, query_counts = _vectorize(query)
+        if not len(self.note_ids) or not len(query_buckets):
+            return []
+
+        ids, rows = np.unique(self.note_ids, return_inverse=True)
+        df = np.bincount(self.buckets, minlength=RETRIEVAL_DIM)
+        idf = np.log((1 + len(ids)) / (1 + df)) + 1
+        weights = (1 + np.log(self.counts)) * idf[self.buckets]
+        norms = np.sqrt(np.bincount(rows, weights=weights ** 2, minlength=len(ids)))
+
+        query_weights = (1 + np.log(query_counts)) * idf[query_buckets]
+        query_vector = np.zeros(RETRIEVAL_DIM, dtype=np.float64)
+        query_vector[query_buckets] = query_weights / np.linalg.norm(query_weights)
+
+        scores = np.bincount(rows, weights=weights * query_vector[self.buckets], minlength=len(ids)) / norms
+        top = np.argsort(-scores)[:limit]
+        return [int(ids[i]) for i in top if scores[i] >= min_score]
+
+    def save(self, path):
+        # Пишем во временный файл и подменяем, чтобы не оставить битый индекс
+        with open(f"{path}.tmp", "wb") as file:
+            np.savez(file, note_ids=self.note_ids, buckets=self.buckets, counts=self.counts,
+                     version=np.int64(self.version))
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            version = int(data["version"]) if "version" in data.files else 0
+            return cls(data["note_ids"], data["buckets"], data["counts"], version)
+
+
+def _index_path(user_id):
+    return os.path.join(RETRIEVAL_DIR, f"{user_id}.npz")
+
+
+def _log_path(user_id):
+    return os.path.join(RETRIEVAL_DIR, f"{user_id}.log")
+
+
+@contextmanager
+def _file_lock(user_id):
+    """Блокировка файлов индекса пользователя, действует между процессами и потоками"""
+    os.makedirs(RETRIEVAL_DIR, exist_ok=True)
+    with open(os.path.join(RETRIEVAL_DIR, f"{user_id}.lock"), "a+b") as file:
+        if fcntl:
+            fcntl.flock(file, fcntl.LOCK_EX)
+        else:
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(file, fcntl.LOCK_UN)
+            else:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _read_log(user_id):
+    if not os.path.isfile(_log_path(user_id)):
+        return []
+    with open(_log_path(user_id), encoding="utf-8") as file:
+        # Оборванная последняя строка (сбой во время записи) пропускается
+        changes = [json.loads(line) for line in file if line.endswith("\n")]
+    # Процессы дописывают изменения после коммита и могут сделать это не в порядке версий
+    return sorted(changes, key=lambda change: change.get("version", 0))
+
+
+def _replay(index, changes):
+    """Применяет изменения подряд идущих версий; возвращает (индекс, непримененные изменения)"""
+    pending = []
+    for change in changes:
+        version = change.get("version", 0)
+        if version <= index.version:
+            continue
+        if version == index.version + 1 and not pending:
+            index = index.apply(change)
+        else:
+            # Пропущенную версию еще не дописали: все, что после нее, ждет в журнале
+            pending.append(change)
+    return index, pending
+
+
+def _load(user_id):
+    """Снимок с диска с примененным журналом, None — если индекс еще не строили. Вызывается под блокировкой"""
+    if not os.path.isfile(_index_path(user_id)):
+        return None
+    return _replay(UserIndex.load(_index_path(user_id)), _read_log(user_id))[0]
+
+
+def _cached(user_id):
+    with _lock:
+        if user_id in _indexes:
+            _indexes.move_to_end(user_id)
+            return _indexes[user_id]
+    return None
+
+
+def get_index(user_id, version):
+    """
+    Индекс пользователя не старее версии version: из памяти или с диска.
+    None — если индекс еще не строили или на диске нет изменений до этой версии
+    (тогда его нужно построить заново по базе и сохранить через save_index).
+    """
+    user_id = str(user_id)
+    if (index := _cached(user_id)) is not None and index.version >= version:
+        return index
+
+    with _file_lock(user_id):
+        index = _load(user_id)
+    if index is None or index.version < version:
+        return None
+    _remember(user_id, index)
+    return index
+
+
+def save_index(user_id, index):
+    """Записывает снимок индекса целиком. Изменения новее index.version, уже дописанные
+    в журнал другими процессами, применяются к снимку, а не теряются
+    """
+    user_id = str(user_id)
+    with _file_lock(user_id):
+        if os.path.isfile(_index_path(user_id)):
+            with np.load(_index_path(user_id)) as data:
+                if "version" in data.files and int(data["version"]) > index.version:
+                    # На диске уже более новый снимок
+                    return
+        index, pending = _replay(index, _read_log(user_id))
+        _write(user_id, index, pending)
+    _remember(user_id, index)
+
+
+def _write(user_id, index, pending):
+    index.save(_index_path(user_id))
+    if pending:
+        with open(f"{_log_path(user_id)}.tmp", "w", encoding="utf-8") as file:
+            file.writelines(json.dumps(change, ensure_ascii=False) + "\n" for change in pending)
+        os.replace(f"{_log_path(user_id)}.tmp", _log_path(user_id))
+    elif os.path.isfile(_log_path(user_id)):
+        os.remove(_log_path(user_id))
+
+
+def append_change(user_id, change):
+    """Дописывает в журнал изменение версии change["version"] (вызывается после коммита в базу)"""
+    user_id = str(user_id)
+    with _file_lock(user_id):
+        with open(_log_path(user_id), "a", encoding="utf-8") as file:
+            file.write(json.dumps(change, ensure_ascii=False) + "\n")
+            size = file.tell()
+        if size > RETRIEVAL_LOG_LIMIT and os.path.isfile(_index_path(user_id)):
+            index, pending = _replay(UserIndex.load(_index_path(user_id)), _read_log(user_id))
+            _write(user_id, index, pending)
+            _remember(user_id, index)
+            return
+
+    # Индекс в памяти обновляем, только если он ровно на одну версию старше, иначе перечитаем при чтении
+    if (index := _cached(user_id)) is not None:
+        if index.version + 1 == change["version"]:
+            _remember(user_id, index.apply(change))
+        else:
+            with _lock:
+                _indexes.pop(user_id, None)
+
+
+def _remember(user_id, index):
+    with _lock:
+        _indexes[user_id] = index
+        _indexes.move_to_end(user_id)
+        if len(_indexes) > RETRIEVAL_CACHE_SIZE:
+            _indexes.popitem(last=False)
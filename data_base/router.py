@@ -0,0 +1,188 @@
+import os
+import zlib
+import asyncio
+import argparse
+from collections import OrderedDict, defaultdict
+
+from sqlalchemy import select, insert, update, delete, func, bindparam
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+import config  # noqa: F401 - DATABASE_URL и шарды могут быть заданы в .env
+from data_base.engine import DB_SHARDS, engine, get_engine, get_shard_session, dispose_engines
+from data_base.models import Catalog, Note, KnowledgeVersion, UserShard, FsmRecord
+from data_base import retrieval
+
+# Роутер хранилища: каталоги и знания пользователя лежат в одном из DB_SHARDS шардов,
+# у каждого шарда своя база SQLite со своей блокировкой записи, поэтому изменения
+# разных пользователей не ждут друг друга. Шард пользователя записан в справочнике
+# user_shard основной базы; новый пользователь попадает в шард по хешу своего id.
+# Сколько записей справочника держать в памяти процесса
+ROUTER_CACHE_SIZE = int(os.getenv("ROUTER_CACHE_SIZE", 100000))
+# Сколько знаний переносить одним запросом
+MOVE_BATCH = 1000
+
+_user_shards = OrderedDict()
+
+
+def place(user_id, shards=DB_SHARDS):
+    """Шард по умолчанию: стабильный хеш id, одинаковый во всех процессах"""
+    return zlib.crc32(str(user_id).encode()) % shards
+
+
+async def get_shard(user_id):
+    """Номер шарда пользователя; нового пользователя записывает в справочник"""
+    user_id = str(user_id)
+    if user_id in _user_shards:
+        _user_shards.move_to_end(user_id)
+        return _user_shards[user_id]
+
+    if (shard := await _lookup(user_id)) is None:
+        # Другой процесс мог записать пользователя раньше: берем то, что в справочнике
+        async with engine.begin() as conn:
+            await conn.execute(sqlite_insert(UserShard).values(user_id=user_id, shard=place(user_id))
+                               .on_conflict_do_nothing())
+            shard = await conn.scalar(select(UserShard.shard).where(UserShard.user_id == user_id))
+    if shard >= DB_SHARDS:
+        raise RuntimeError(f"User {user_id} is stored in shard {shard}, but DB_SHARDS={DB_SHARDS}: "
+                           f"run python -m data_base.router rebalance")
+
+    _remember(user_id, shard)
+    return shard
+
+
+async def _lookup(user_id):
+    async with engine.connect() as conn:
+        return await conn.scalar(select(UserShard.shard).where(UserShard.user_id == user_id))
+
+
+def _remember(user_id, shard):
+    _user_shards[user_id] = shard
+    _user_shards.move_to_end(user_id)
+    if len(_user_shards) > ROUTER_CACHE_SIZE:
+        _user_shards.popitem(last=False)
+
+
+async def get_session(user_id):
+    """Сессия текущей задачи в шарде пользователя"""
+    return get_shard_session(await get_shard(user_id))
+
+
+async def _delete_user(conn, user_id):
+    await conn.execute(delete(Note).where(Note.user_id == user_id))
+    await conn.execute(delete(Catalog).where(Catalog.user_id == user_id))
+    await conn.execute(delete(KnowledgeVersion).where(KnowledgeVersion.user_id == user_id))
+
+
+async def move_user(user_id, target):
+    """
+    Переносит каталоги и знания пользователя в шард target. Запускать при остановленном боте.
+
+    id каталогов и знаний в разных шардах пересекаются, поэтому в новом шарде они выдаются заново:
+    после переноса сбрасывается состояние диалога пользователя и перестраивается его индекс поиска.
+    Прерванный перенос можно повторить: пока справочник не переключен, данные читаются из старого шарда.
+    """
+    user_id = str(user_id)
+    # Шард читаем из справочника напрямую: при уменьшении DB_SHARDS он может быть за пределами нового числа
+    source = await _lookup(user_id)
+    if source is None:
+        source = place(user_id)
+    if source == target:
+        return False
+
+    async with get_engine(source).connect() as src, get_engine(target).begin() as dst:
+        # Остатки прерванного переноса
+        await _delete_user(dst, user_id)
+
+        levels = defaultdict(list)
+        for row in (await src.execute(select(Catalog.id, Catalog.parent, Catalog.value, Catalog.path)
+                                      .where(Catalog.user_id == user_id))).all():
+            levels[row.path.count("/") - 1].append(row)
+
+        # Уровень за уровнем, как при импорте: родитель получает новый id раньше потомков
+        ids, paths = {}, {}
+        for depth in sorted(levels):
+            level = levels[depth]
+            new_ids = (await dst.scalars(
+                insert(Catalog).returning(Catalog.id, sort_by_parameter_order=True),
+                [{"user_id": user_id, "value": row.value, "parent": ids.get(row.parent)} for row in level])).all()
+            for row, catalog_id in zip(level, new_ids):
+                ids[row.id] = catalog_id
+                paths[row.id] = f"{paths.get(row.parent, '/')}{catalog_id}/"
+            await dst.execute(update(Catalog).where(Catalog.id == bindparam("catalog_id"))
+                              .values(path=bindparam("new_path")),
+                              [{"catalog_id": ids[row.id], "new_path": paths[row.id]} for row in level])
+
+        result = await src.stream(select(Note.catalog, Note.value).where(Note.user_id == user_id).order_by(Note.id))
+        async for rows in result.partitions(MOVE_BATCH):
+            await dst.execute(insert(Note), [{"user_id": user_id, "value": row.value,
+                                              "catalog": ids.get(row.catalog)} for row in rows])
+
+        # Новая версия базы знаний: ответы из кэша LLM пересчитаются
+        version = await src.scalar(select(KnowledgeVersion.version).where(KnowledgeVersion.user_id == user_id))
+        await dst.execute(insert(KnowledgeVersion).values(user_id=user_id, version=(version or 0) + 1))
+
+    async with engine.begin() as conn:
+        await conn.execute(sqlite_insert(UserShard).values(user_id=user_id, shard=target)
+                           .on_conflict_do_update(index_elements=[UserShard.user_id], set_={"shard": target}))
+        # В состоянии диалога могут остаться старые id
+        await conn.execute(delete(FsmRecord).where(FsmRecord.user == user_id))
+    _remember(user_id, target)
+
+    async with get_engine(source).begin() as conn:
+        await _delete_user(conn, user_id)
+
+    async with get_engine(target).connect() as conn:
+        notes = (await conn.execute(select(Note.id, Note.value).where(Note.user_id == user_id))).all()
+    retrieval.save_index(user_id, retrieval.UserIndex.build(notes, (version or 0) + 1))
+    return True
+
+
+async def rebalance(shards=DB_SHARDS, dry_run=False):
+    """Переносит пользователей, чей шард не совпадает с place(user_id, shards). Возвращает число переносов"""
+    async with engine.connect() as conn:
+        rows = (await conn.execute(select(UserShard.user_id, UserShard.shard))).all()
+
+    moves = [(row.user_id, row.shard, place(row.user_id, shards)) for row in rows
+             if row.shard != place(row.user_id, shards)]
+    for user_id, source, target in moves:
+        print(f"{user_id}: {source} -> {target}")
+        if not dry_run:
+            await move_user(user_id, target)
+    return len(moves)
+
+
+async def get_stats():
+    """Число пользователей в каждом шарде"""
+    async with engine.connect() as conn:
+        return dict((await conn.execute(select(UserShard.shard, func.count())
+                                        .group_by(UserShard.shard).order_by(UserShard.shard))).all())
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Шарды хранилища: статистика и перенос пользователей "
+                                                 "(запускать при остановленном боте)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats", help="пользователи по шардам")
+    rebalance_parser = commands.add_parser("rebalance", help="разложить пользователей по DB_SHARDS шардам")
+    rebalance_parser.add_argument("--dry-run", action="store_true", help="только показать переносы")
+    move_parser = commands.add_parser("move", help="перенести одного пользователя")
+    move_parser.add_argument("user_id")
+    move_parser.add_argument("shard", type=int)
+    args = parser.parse_args()
+
+    try:
+        if args.command == "stats":
+            for shard, users in (await get_stats()).items():
+                print(f"shard {shard}: {users} users")
+        elif args.command == "rebalance":
+            print(f"moved: {await rebalance(dry_run=args.dry_run)}")
+        elif not 0 <= args.shard < DB_SHARDS:
+            parser.error(f"shard must be in 0..{DB_SHARDS - 1}")
+        else:
+            print("moved" if await move_user(args.user_id, args.shard) else "already there")
+    finally:
+        await dispose_engines()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,141 +1,415 @@
+import os
+import re
+import asyncio
+from collections import defaultdict
 from typing import List
 
-from sqlalchemy import create_engine, select, and_
-from sqlalchemy.orm import sessionmaker
-from fuzzywuzzy import fuzz
+from sqlalchemy import select, and_, text, delete, func, insert, update
 from sqlalchemy import or_
-from .models import Note
-from sqlalchemy.orm import Session
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
-from data_base.models import catalog, Note
+from data_base.models import Catalog, Note, KnowledgeVersion
+from data_base import retrieval
+from data_base.router import get_session
 
-engine = create_engine('sqlite:///data.db')
+# Минимальная похожесть пути каталога (0-100), при которой берем знания из него
+CATALOG_MATCH_CUTOFF = 70
+# Размер страницы в списках каталогов и знаний и длина превью знания
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", 10))
+PREVIEW_LENGTH = int(os.getenv("PREVIEW_LENGTH", 300))
+# Сколько знаний вставлять одним запросом при импорте
+IMPORT_BATCH = int(os.getenv("IMPORT_BATCH", 1000))
+# Кэш путей каталогов для нечеткого поиска: user_id -> (версия базы знаний, id каталогов, пути в нижнем регистре)
+_path_index = {}
 
-Session = sessionmaker(bind=engine)
-session = Session()
 
-
-def create_catalog(user_id, name, parent_catalog=None):
+async def create_catalog(user_id, name, parent_catalog=None):
     user_id = str(user_id)
-    if parent_catalog and not session.scalars(
-            select(catalog).where(catalog.id == int(parent_catalog))).first().user_id == user_id:
-        return False
+    session = await get_session(user_id)
+    parent_path = "/"
+    if parent_catalog:
+        parent = await session.get(Catalog, int(parent_catalog))
+        if parent.user_id != user_id:
+            return False
+        parent_path = parent.path
 
-    catalog = catalog(user_id=user_id, value=name, parent=int(parent_catalog) if parent_catalog else None)
+    catalog = Catalog(user_id=user_id, value=name, parent=int(parent_catalog) if parent_catalog else None)
     session.add(catalog)
-    session.commit()
+    await session.flush()
+    catalog.path = f"{parent_path}{catalog.id}/"
+    version = await _bump_kb_version(user_id)
+    await session.commit()
+    invalidate_path_index(user_id)
+    await _update_retrieval_index(user_id, {"version": version})
     return catalog
 
 
-def delete_catalog(user_id, catalog_id):
+async def delete_catalog(user_id, catalog_id):
+    """Удаляет каталог со всеми вложенными каталогами и знаниями в одной транзакции"""
     user_id = str(user_id)
-    if (maker := session.scalars(select(catalog).where(catalog.id == int(catalog_id))).first()).user_id == user_id:
-        maker.delete()
+    session = await get_session(user_id)
+    if (maker := await session.get(Catalog, int(catalog_id))).user_id == user_id:
+        subtree = select(Catalog.id).where(Catalog.user_id == user_id, _subtree(maker.path))
+        note_ids = (await session.scalars(select(Note.id).where(Note.catalog.in_(subtree)))).all()
+        await session.execute(delete(Note).where(Note.catalog.in_(subtree)),
+                              execution_options={"synchronize_session": False})
+        await session.execute(delete(Catalog).where(Catalog.user_id == user_id, _subtree(maker.path)),
+                              execution_options={"synchronize_session": False})
+        version = await _bump_kb_version(user_id)
+        await session.commit()
+        await _update_retrieval_index(user_id, {"version": version, "remove": list(note_ids)})
+        invalidate_path_index(user_id)
         return True
     return False
 
 
-def create_note(user_id, catalog_id, value):
-    with Session() as session:
-        note = Note(user_id=str(user_id), value=value, catalog=catalog_id)
-        session.add(note)
-        session.commit()
+def _subtree(path):
+    """Условие на каталог path и всех его потомков: диапазон по индексу ix_catalog_user_id_path.
+    Пути состоят из цифр и "/", а "0" следует сразу за "/", поэтому "/1/5/" <= path < "/1/50"
+    """
+    return and_(Catalog.path >= path, Catalog.path < path[:-1] + "0")
+
+
+async def create_note(user_id, catalog_id, value):
+    session = await get_session(user_id)
+    note = Note(user_id=str(user_id), value=value, catalog=catalog_id)
+    session.add(note)
+    version = await _bump_kb_version(user_id)
+    await session.commit()
+    await _update_retrieval_index(user_id, {"version": version, "id": note.id, "text": value})
     return note
 
 
-def delete_note(user_id, note_id):
+async def delete_note(user_id, note_id):
     user_id = str(user_id)
-    note = session.scalars(select(Note).where(Note.id == int(note_id))).first()
-    if note.get_catalog().user_id == user_id:
-        note.delete()
+    session = await get_session(user_id)
+    note = await session.get(Note, int(note_id))
+    if note.user_id == user_id:
+        await note.delete(session)
+        version = await _bump_kb_version(user_id)
+        await session.commit()
+        await _update_retrieval_index(user_id, {"version": version, "remove": [int(note_id)]})
         return True
     return False
 
 
-def delete_note_pos(user_id, catalog_id, note_pos):
-    notes = get_notes(user_id, catalog_id)
-    note_id = notes[int(note_pos)]["id"]
-    delete_note(user_id, note_id)
-
-def get_root_catalogs(user_id) -> List[catalog]:
-    catalogs = session.scalars(select(catalog).filter(and_(catalog.user_id == str(user_id)), catalog.parent == None))
+async def get_root_catalogs(user_id) -> List[Catalog]:
+    session = await get_session(user_id)
+    catalogs = await session.scalars(select(Catalog).filter(and_(Catalog.user_id == str(user_id)),
+                                                            Catalog.parent == None))
     # catalogs = [i.to_dict() for i in catalogs]
-    return catalogs
+    return catalogs.all()
 
 
-def get_child_catalogs(user_id, catalog):
-    catalogs = session.scalars(select(catalog).where(catalog.user_id == str(user_id)).filter(catalog.parent == int(catalog)))
+async def get_child_catalogs(user_id, catalog):
+    session = await get_session(user_id)
+    catalogs = await session.scalars(select(Catalog).where(Catalog.user_id == str(user_id))
+                                     .filter(Catalog.parent == int(catalog)))
     # catalogs = [i.to_dict() for i in catalogs]
-    return catalogs
+    return catalogs.all()
+
+
+async def _get_page(session, query, column, after, before, limit):
+    """Страница по ключу column: следующая после after или предыдущая перед before.
+    Возвращает (строки, есть ли предыдущая страница, есть ли следующая)
+    """
+    if before is not None:
+        rows = (await session.execute(query.where(column < before).order_by(column.desc()).limit(limit + 1))).all()
+        return rows[:limit][::-1], len(rows) > limit, True
+    rows = (await session.execute(query.where(column > (after or 0)).order_by(column).limit(limit + 1))).all()
+    return rows[:limit], after is not None, len(rows) > limit
+
+
+async def get_catalogs_page(user_id, parent=None, after=None, before=None, limit=PAGE_SIZE):
+    """Страница подкаталогов parent (корневых, если parent не задан): строки (id, value)"""
+    parent_filter = Catalog.parent == int(parent) if parent else Catalog.parent.is_(None)
+    query = select(Catalog.id, Catalog.value).where(Catalog.user_id == str(user_id), parent_filter)
+    return await _get_page(await get_session(user_id), query, Catalog.id, after, before, limit)
 
 
-def get_path(user_id, catalog):
-    catalog = session.scalars(select(catalog).filter(and_(catalog.user_id == str(user_id),
-                                                        catalog.id == int(catalog)))).first()
-    if catalog.parent:
-        return get_path(user_id, catalog.parent) + [catalog.value, ]
-    else:
-        return [catalog.value, ]
+async def get_notes_page(user_id, catalog_id, after=None, before=None, limit=PAGE_SIZE):
+    """Страница знаний каталога без загрузки полных текстов: строки (id, preview, length)"""
+    query = select(Note.id, func.substr(Note.value, 1, PREVIEW_LENGTH).label("preview"),
+                   func.length(Note.value).label("length")) \
+        .where(Note.catalog == int(catalog_id), Note.user_id == str(user_id))
+    return await _get_page(await get_session(user_id), query, Note.id, after, before, limit)
 
 
-def get_parent_catalog(user_id, catalog):
-    catalog = session.scalars(select(catalog).filter(and_(catalog.user_id == str(user_id),
-                                                        catalog.id == int(catalog)))).first()
-    return catalog.parent
+async def get_path(user_id, catalog):
+    session = await get_session(user_id)
+    path = await session.scalar(select(Catalog.path).filter(and_(Catalog.user_id == str(user_id),
+                                                               Catalog.id == int(catalog))))
+    ids = [int(i) for i in path.split("/") if i]
+    values = dict((await session.execute(select(Catalog.id, Catalog.value).where(Catalog.id.in_(ids)))).all())
+    return [values[i] for i in ids]
 
 
-def get_notes_from_location(user_id, location):
+async def get_parent_catalog(user_id, catalog):
+    session = await get_session(user_id)
+    return await session.scalar(select(Catalog.parent).filter(and_(Catalog.user_id == str(user_id),
+                                                                 Catalog.id == int(catalog))))
+
+
+async def get_notes_from_location(user_id, location):
     if isinstance(location, dict):
         location = location.get('content', '').strip()
-    path = [i for i in location.split("/") if i]
-    
-    all_catalogs = session.scalars(select(catalog).where(catalog.user_id == user_id)).all()
-    best_match = None
-    best_ratio = 0
-    for catalog in all_catalogs:
-        catalog_path = "/".join(get_path(user_id, catalog.id))
-        ratio = fuzz.ratio(location.lower(), catalog_path.lower())
-        if ratio > best_ratio:
-            best_ratio = ratio
-            best_match = catalog
-    
+
     notes = []
-    if best_match and best_ratio > 70:
-        notes = [note.to_dict() for note in best_match.get_notes()]
+    if (catalog_id := await match_catalog(user_id, location)) is not None:
+        notes = await get_notes(user_id, catalog_id)
 
     if not notes:
-        keywords = set(location.lower().split())
-        all_notes = session.scalars(select(Note).join(catalog).where(catalog.user_id == user_id)).all()
-        for note in all_notes:
-            note_text = note.value.lower()
-            if any(keyword in note_text for keyword in keywords):
-                notes.append(note.to_dict())
-    
+        notes = await search_notes(user_id, location)
+
     return notes
 
-def get_notes(user_id, catalog_id):
-    with Session() as session:
-        catalog = session.query(catalog).filter_by(id=catalog_id, user_id=user_id).first()
-        if catalog:
-            notes = session.query(Note).filter_by(catalog=catalog_id, user_id=user_id).all()
-            return [note.to_dict() for note in notes]
-    return []
 
-def read_notes(user_id, catalog):
-    notes = get_notes(user_id, catalog)
+async def _get_path_index(user_id):
+    """Возвращает (id, полные пути) всех каталогов пользователя, строя индекс одним запросом.
+    Индекс помечен версией базы знаний: каталоги, добавленные другим процессом, повышают ее
+    """
+    session = await get_session(user_id)
+    version = await get_kb_version(user_id)
+    if user_id not in _path_index or _path_index[user_id][0] != version:
+        rows = (await session.execute(select(Catalog.id, Catalog.value, Catalog.path)
+                                      .where(Catalog.user_id == user_id))).all()
+        values = {row.id: row.value for row in rows}
+        _path_index[user_id] = (
+            version,
+            [row.id for row in rows],
+            ["/".join(values[int(i)] for i in row.path.split("/") if i).lower() for row in rows],
+        )
+    return _path_index[user_id][1:]
+
+
+def invalidate_path_index(user_id):
+    _path_index.pop(str(user_id), None)
+
+
+async def match_catalog(user_id, location, score_cutoff=CATALOG_MATCH_CUTOFF):
+    """Находит каталог, путь которого лучше всего совпадает с location, или None"""
+    from rapidfuzz import fuzz, process
+
+    ids, paths = await _get_path_index(str(user_id))
+    match = process.extractOne(location.lower(), paths, scorer=fuzz.ratio, score_cutoff=score_cutoff)
+    return ids[match[2]] if match else None
+
+
+def _fts_query(user_id, query):
+    """Собирает выражение MATCH: слова через OR, все ищем по префиксу, у длинных слов отбрасываем окончание.
+    ё заменяем на е, как и в индексе
+    """
+    terms = []
+    for word in dict.fromkeys(re.findall(r"\w+", query.lower().replace("ё", "е"))):
+        if len(word) < 2:
+            continue
+        terms.append(f'"{word[:-2]}"*' if len(word) > 5 else f'"{word}"*')
+    if not terms:
+        return None
+    return f'user_id : "{user_id}" AND ({" OR ".join(terms)})'
+
+
+async def search_notes(user_id, query, limit=20):
+    """Полнотекстовый поиск по знаниям пользователя, результаты ранжированы по BM25"""
+    session = await get_session(user_id)
+    match = _fts_query(str(user_id), query)
+    if not match:
+        return []
+    rows = (await session.execute(text(
+        "SELECT note.id, note.value FROM note_fts JOIN note ON note.id = note_fts.rowid "
+        "WHERE note_fts MATCH :match ORDER BY bm25(note_fts, 1.0, 0.0) LIMIT :limit"
+    ), {"match": match, "limit": limit})).all()
+    return [{"value": row.value, "id": row.id} for row in rows]
+
+
+async def get_notes(user_id, catalog_id):
+    session = await get_session(user_id)
+    notes = await session.scalars(select(Note).filter_by(catalog=int(catalog_id), user_id=str(user_id)))
+    return [note.to_dict() for note in notes]
+
+
+async def get_note(user_id, note_id):
+    session = await get_session(user_id)
+    note = await session.scalar(select(Note).filter(Note.id == int(note_id), Note.user_id == str(user_id)))
+    return note.to_dict() if note else None
+
+
+async def read_notes(user_id, catalog):
+    notes = await get_notes(user_id, catalog)
     return "\n".join([i["value"] for i in notes])
 
-def get_tree(user_id):
-    return "".join([i.tree() for i in get_root_catalogs(user_id)])
-def update_note(user_id, note_id, new_text):
-    with Session() as session:
-        note = session.query(Note).filter(Note.id == note_id, Note.user_id == user_id).first()
-        if note:
-            note.value = new_text
-            session.commit()
-            return True
-        return False
+
+async def get_catalog_rows(user_id):
+    """Все каталоги пользователя строками (id, parent, value) в порядке создания"""
+    session = await get_session(user_id)
+    return (await session.execute(select(Catalog.id, Catalog.parent, Catalog.value)
+                                  .where(Catalog.user_id == str(user_id))
+                                  .order_by(Catalog.id))).all()
+
+
+async def get_tree(user_id):
+    """Строит дерево каталогов пользователя одним запросом (с отступами по уровням)"""
+    rows = await get_catalog_rows(user_id)
+    childs = defaultdict(list)
+    for row in rows:
+        childs[row.parent].append(row)
+
+    data = []
+    stack = [(row, 2) for row in reversed(childs[None])]
+    while stack:
+        row, indent = stack.pop()
+        data.append(f'{" " * indent}{row.value}{"/" if childs[row.id] else ""}\n')
+        stack.extend((child, indent + 2) for child in reversed(childs[row.id]))
+    return "".join(data)
+
+
+async def update_note(user_id, note_id, new_text):
+    session = await get_session(user_id)
+    note = await session.scalar(select(Note).filter(Note.id == int(note_id), Note.user_id == str(user_id)))
+    if note:
+        note.value = new_text
+        version = await _bump_kb_version(user_id)
+        await session.commit()
+        await _update_retrieval_index(user_id, {"version": version, "id": int(note_id), "text": new_text})
+        return True
+    return False
+
+
+async def import_tree(user_id, root_name, catalog_paths, notes):
+    """
+    Массово создает каталоги и знания в новом корневом каталоге root_name одной транзакцией.
+
+    catalog_paths — пути каталогов кортежами имен, notes — итератор (путь каталога, текст);
+    знания читаются и вставляются пачками по IMPORT_BATCH, не собираясь в памяти целиком.
+    Возвращает (число созданных каталогов, число знаний).
+    """
+    user_id = str(user_id)
+    session = await get_session(user_id)
+    root = Catalog(user_id=user_id, value=root_name)
+    session.add(root)
+    await session.flush()
+    root.path = f"/{root.id}/"
+
+    all_paths = {path[:depth] for path in catalog_paths for depth in range(1, len(path) + 1)}
+    ids, paths = {(): root.id}, {(): root.path}
+    # Уровень за уровнем: один INSERT ... RETURNING и один UPDATE путей на уровень
+    for depth in range(1, max(map(len, all_paths), default=0) + 1):
+        level = sorted(path for path in all_paths if len(path) == depth)
+        new_ids = (await session.scalars(
+            insert(Catalog).returning(Catalog.id, sort_by_parameter_order=True),
+            [{"user_id": user_id, "value": path[-1], "parent": ids[path[:-1]]} for path in level])).all()
+        for path, catalog_id in zip(level, new_ids):
+            ids[path] = catalog_id
+            paths[path] = f"{paths[path[:-1]]}{catalog_id}/"
+        await session.execute(update(Catalog), [{"id": ids[path], "path": paths[path]} for path in level])
+
+    count, batch = 0, []
+    for path, value in notes:
+        batch.append({"user_id": user_id, "value": value, "catalog": ids[path]})
+        if len(batch) >= IMPORT_BATCH:
+            await session.execute(insert(Note), batch)
+            count, batch = count + len(batch), []
+    if batch:
+        await session.execute(insert(Note), batch)
+        count += len(batch)
+
+    await _bump_kb_version(user_id)
+    await session.commit()
+    invalidate_path_index(user_id)
+    # После массовой вставки дешевле перестроить индекс целиком, чем добавлять по одному
+    await _build_retrieval_index(user_id)
+    return len(all_paths) + 1, count
+
+
+async def export_tree(user_id):
+    """
+    Знания пользователя для выгрузки: (пути всех каталогов, асинхронный итератор (путь, id, текст)).
+    Пути — кортежи имен каталогов; знания читаются из базы потоком.
+    """
+    session = await get_session(user_id)
+    rows = await get_catalog_rows(user_id)
+    parents = {row.id: row.parent for row in rows}
+    # Одноименные соседние каталоги различаем по id, иначе при выгрузке они сольются
+    names, taken = {}, set()
+    for row in rows:
+        name = row.value if (row.parent, row.value) not in taken else f"{row.value} ({row.id})"
+        taken.add((row.parent, name))
+        names[row.id] = name
+
+    paths = {}
+    for row in rows:
+        path, catalog_id = [], row.id
+        while catalog_id is not None:
+            path.append(names[catalog_id])
+            catalog_id = parents[catalog_id]
+        paths[row.id] = tuple(reversed(path))
+
+    async def notes():
+        result = await session.stream(select(Note.id, Note.catalog, Note.value)
+                                      .where(Note.user_id == str(user_id))
+                                      .order_by(Note.catalog, Note.id)
+                                      .execution_options(yield_per=IMPORT_BATCH))
+        async for row in result:
+            yield paths.get(row.catalog, ()), row.id, row.value
+
+    return paths, notes()
+
+
+async def _bump_kb_version(user_id):
+    """Повышает версию базы знаний в текущей транзакции и возвращает новую версию"""
+    session = await get_session(user_id)
+    return await session.scalar(sqlite_insert(KnowledgeVersion)
+                                .values(user_id=str(user_id), version=1)
+                                .on_conflict_do_update(index_elements=[KnowledgeVersion.user_id],
+                                                       set_={"version": KnowledgeVersion.version + 1})
+                                .returning(KnowledgeVersion.version))
+
+
+async def get_kb_version(user_id):
+    """Текущая версия базы знаний пользователя (0, если он еще ничего не менял)"""
+    session = await get_session(user_id)
+    return await session.scalar(select(KnowledgeVersion.version)
+                                .where(KnowledgeVersion.user_id == str(user_id))) or 0
+
+
+async def _build_retrieval_index(user_id):
+    """Строит индекс по базе; версия и знания читаются в одной транзакции, поэтому согласованы"""
+    user_id = str(user_id)
+    session = await get_session(user_id)
+    version = await get_kb_version(user_id)
+    notes = (await session.execute(select(Note.id, Note.value).where(Note.user_id == user_id))).all()
+    index = await asyncio.to_thread(retrieval.UserIndex.build, notes, version)
+    await asyncio.to_thread(retrieval.save_index, user_id, index)
+    return index
+
+
+async def _get_retrieval_index(user_id, version=None):
+    # Другой процесс (бот или воркер задач) мог изменить знания: индекс не должен быть старее версии в базе.
+    # Чтение с диска, построение и поиск по индексу нагружают CPU, поэтому выполняются в потоке
+    if version is None:
+        version = await get_kb_version(user_id)
+    if (index := await asyncio.to_thread(retrieval.get_index, str(user_id), version)) is None:
+        index = await _build_retrieval_index(user_id)
+    return index
+
+
+async def _update_retrieval_index(user_id, change):
+    """Дописывает изменение версии change["version"] в журнал индекса, не перезаписывая снимок"""
+    await asyncio.to_thread(retrieval.append_change, user_id, change)
+
+
+async def get_relevant_notes(user_id, query, limit=5, version=None):
+    """Подбирает знания, похожие на вопрос, по локальному индексу без запроса к LLM.
+    version — уже прочитанная версия базы знаний, чтобы не запрашивать ее повторно
+    """
+    session = await get_session(user_id)
+    note_ids = await asyncio.to_thread((await _get_retrieval_index(user_id, version)).search, query, limit)
+    if not note_ids:
+        return []
+    values = dict((await session.execute(select(Note.id, Note.value)
+                                         .where(Note.id.in_(note_ids), Note.user_id == str(user_id)))).all())
+    return [{"value": values[i], "id": i} for i in note_ids if i in values]
 
 
 if __name__ == '__main__':
-    print(get_tree("12"))
\ No newline at end of file
+    print(asyncio.run(get_tree("12")))
@@ -0,0 +1,195 @@
+import os
+import copy
+import json
+import time
+import typing
+import asyncio
+
+from aiogram.dispatcher.storage import BaseStorage
+from sqlalchemy import select, delete, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from data_base.engine import engine
+from data_base.models import FsmRecord
+
+# Как часто сбрасывать накопленные изменения в базу (сек)
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", 0.5))
+# Через сколько секунд бездействия незавершенный диалог считается брошенным
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", 7 * 24 * 3600))
+# Сколько секунд держать в памяти состояние, которое не меняется
+FSM_CACHE_IDLE = int(os.getenv("FSM_CACHE_IDLE", 600))
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище в SQLite: состояния диалогов переживают перезапуск бота.
+
+    Чтение идет из памяти, изменения копятся и записываются в базу одной транзакцией
+    раз в FSM_FLUSH_INTERVAL секунд. Брошенные состояния удаляются через FSM_STATE_TTL.
+    """
+
+    def __init__(self, flush_interval=FSM_FLUSH_INTERVAL, ttl=FSM_STATE_TTL, cache_idle=FSM_CACHE_IDLE):
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.cache_idle = cache_idle
+        self._records = {}
+        self._dirty = set()
+        self._flush_task = None
+        self._lock = asyncio.Lock()
+
+    async def _record(self, chat, user):
+        chat, user = map(str, self.check_address(chat=chat, user=user))
+        key = (chat, user)
+        if key not in self._records:
+            async with engine.connect() as conn:
+                row = (await conn.execute(select(FsmRecord.state, FsmRecord.data, FsmRecord.bucket)
+                                          .where(FsmRecord.chat == chat, FsmRecord.user == user,
+                                                 FsmRecord.updated_at > time.time() - self.ttl))).first()
+            # Пока шел запрос, запись могла появиться из другой задачи
+            if key not in self._records:
+                self._records[key] = {
+                    "state": row.state if row else None,
+                    "data": json.loads(row.data) if row else {},
+                    "bucket": json.loads(row.bucket) if row else {},
+                    "updated_at": time.time(),
+                }
+        return key, self._records[key]
+
+    def _touch(self, key):
+        self._records[key]["updated_at"] = time.time()
+        self._dirty.add(key)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # Изменения, пришедшие во время записи, уходят следующей пачкой
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if not self._dirty:
+                break
+
+    async def flush(self):
+        """Записывает накопленные изменения и чистит просроченные состояния"""
+        async with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            now = time.time()
+            changed, empty = [], []
+            for key in dirty:
+                record = self._records.get(key)
+                if record is None:
+                    continue
+                if record["state"] is None and not record["data"] and not record["bucket"]:
+                    empty.append(key)
+                else:
+                    changed.append({"chat": key[0], "user": key[1], "state": record["state"],
+                                    "data": json.dumps(record["data"], ensure_ascii=False),
+                                    "bucket": json.dumps(record["bucket"], ensure_ascii=False),
+                                    "updated_at": record["updated_at"]})
+
+            try:
+                await self._write(changed, empty, now)
+            except BaseException:
+                self._dirty |= dirty
+                raise
+
+            # Не держим в памяти давно не менявшиеся состояния, они есть в базе
+            for key in [key for key, record in self._records.items()
+                        if key not in self._dirty and record["updated_at"] <= now - self.cache_idle]:
+                del self._records[key]
+
+    async def _write(self, changed, empty, now):
+        async with engine.begin() as conn:
+            if changed:
+                statement = sqlite_insert(FsmRecord)
+                await conn.execute(statement.on_conflict_do_update(
+                    index_elements=[FsmRecord.chat, FsmRecord.user],
+                    set_={column: statement.excluded[column] for column in
+                          ("state", "data", "bucket", "updated_at")}), changed)
+            if empty:
+                await conn.execute(delete(FsmRecord).where(tuple_(FsmRecord.chat, FsmRecord.user).in_(empty)))
+            await conn.execute(delete(FsmRecord).where(FsmRecord.updated_at <= now - self.ttl))
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        key, record = await self._record(chat, user)
+        return record["state"] or self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[str] = None) -> typing.Dict:
+        key, record = await self._record(chat, user)
+        return copy.deepcopy(record["data"])
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        if data is None:
+            data = {}
+        key, record = await self._record(chat, user)
+        record["data"].update(data, **kwargs)
+        self._touch(key)
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        key, record = await self._record(chat, user)
+        record["state"] = self.resolve_state(state)
+        self._touch(key)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key, record = await self._record(chat, user)
+        record["data"] = copy.deepcopy(data or {})
+        self._touch(key)
+
+    async def reset_state(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        await self.set_state(chat=chat, user=user, state=None)
+        if with_data:
+            await self.set_data(chat=chat, user=user, data={})
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        key, record = await self._record(chat, user)
+        return copy.deepcopy(record["bucket"])
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        key, record = await self._record(chat, user)
+        record["bucket"] = copy.deepcopy(bucket or {})
+        self._touch(key)
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        if bucket is None:
+            bucket = {}
+        key, record = await self._record(chat, user)
+        record["bucket"].update(bucket, **kwargs)
+        self._touch(key)
@@ -1,46 +1,242 @@
 import os
-import json
+import re
+import time
+import random
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
 
+import aiohttp
 import openai
-from dotenv import load_dotenv
 
-load_dotenv()
+from config import prompts
+from metrics import LLM_CACHE, LLM_ERRORS, LLM_FIRST_TOKEN_SECONDS, LLM_SECONDS, LLM_TOKENS
+from prompt_builder import count_tokens
+
 openai.api_key = os.getenv("OPENAI_TOKEN")
 openai.api_base = os.getenv("OPENAI_API_BASE")
 
+# Настройки клиента: лимит одновременных запросов, таймаут и повторы
+GPT_CONCURRENCY = int(os.getenv("GPT_CONCURRENCY", 8))
+GPT_TIMEOUT = float(os.getenv("GPT_TIMEOUT", 60))
+GPT_RETRIES = int(os.getenv("GPT_RETRIES", 3))
+GPT_RETRY_DELAY = float(os.getenv("GPT_RETRY_DELAY", 1))
+
+RETRY_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+)
+
+# Кэш ответов: LRU в памяти и SQLite вторым уровнем
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", 1024))
+LLM_CACHE_DB = os.getenv("LLM_CACHE_DB", "llm_cache.db")
+LLM_CACHE_DB_SIZE = int(os.getenv("LLM_CACHE_DB_SIZE", 100000))
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600))
+
+_session = None
+_semaphore = None
+
+
+class AnswerCache:
+    """Кэш ответов LLM с ограничением размера и временем жизни записей"""
+
+    def __init__(self, path, size, db_size, ttl):
+        self.size = size
+        self.db_size = db_size
+        self.ttl = ttl
+        self.memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS llm_cache "
+                         "(key TEXT PRIMARY KEY, answer TEXT NOT NULL, expires REAL NOT NULL, used REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS ix_llm_cache_used ON llm_cache (used)")
+
+    @staticmethod
+    def make_key(prompt, scope):
+        normalized = re.sub(r"\s+", " ", prompt).strip().casefold()
+        model = os.getenv("gpt_model", "gpt-3.5-turbo")
+        return hashlib.sha256(f"{model}\0{scope}\0{normalized}".encode()).hexdigest()
+
+    async def get(self, key):
+        if key in self.memory:
+            expires, answer = self.memory[key]
+            if expires > time.time():
+                self.memory.move_to_end(key)
+                LLM_CACHE.labels("hit").inc()
+                return answer
+            del self.memory[key]
+
+        row = await asyncio.to_thread(self._db_get, key)
+        LLM_CACHE.labels("hit" if row else "miss").inc()
+        if row:
+            self._remember(key, *row)
+            return row[1]
+        return None
+
+    async def set(self, key, answer):
+        expires = time.time() + self.ttl
+        self._remember(key, expires, answer)
+        await asyncio.to_thread(self._db_set, key, answer, expires)
+
+    def _remember(self, key, expires, answer):
+        self.memory[key] = (expires, answer)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+
+    def _db_get(self, key):
+        now = time.time()
+        with self._lock, self._db:
+            row = self._db.execute("SELECT expires, answer FROM llm_cache WHERE key = ? AND expires > ?",
+                                   (key, now)).fetchone()
+            if row:
+                self._db.execute("UPDATE llm_cache SET used = ? WHERE key = ?", (now, key))
+        return row
+
+    def _db_set(self, key, answer, expires):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO llm_cache (key, answer, expires, used) VALUES (?, ?, ?, ?)",
+                             (key, answer, expires, now))
+            self._writes += 1
+            # Чистим просроченные и самые старые записи не на каждой записи
+            if self._writes % 100 == 0:
+                self._db.execute("DELETE FROM llm_cache WHERE expires <= ?", (now,))
+                self._db.execute("DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY used "
+                                 "LIMIT max(0, (SELECT count(*) FROM llm_cache) - ?))", (self.db_size,))
+
+
+answer_cache = AnswerCache(LLM_CACHE_DB, LLM_CACHE_SIZE, LLM_CACHE_DB_SIZE, LLM_CACHE_TTL)
 
-prompts = {}
-with open("prompts.json", "r", encoding="utf-8") as file:
-    prompts = json.load(file)
 
+def _get_session():
+    """Возвращает общую aiohttp-сессию с keep-alive соединениями"""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=GPT_CONCURRENCY, keepalive_timeout=60)
+        _session = aiohttp.ClientSession(connector=connector)
+    return _session
+
+
+def _get_semaphore():
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(GPT_CONCURRENCY)
+    return _semaphore
+
+
+async def close_session():
+    """Закрывает пул соединений (вызывается при остановке бота)"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def get_cached_answer(input_str, cache_scope):
+    """Возвращает ответ из кэша или None"""
+    return await answer_cache.get(AnswerCache.make_key(input_str, cache_scope))
+
+
+async def chat_gpt_query(input_str, cache_scope=None, on_chunk=None):
+    """Выполняет запрос к ChatGPT и обрабатывает ответ
+
+    Если задан cache_scope (например, пользователь и версия его базы знаний),
+    ответ кэшируется по этому ключу и нормализованному тексту запроса.
+    Если задан on_chunk, ответ запрашивается потоком и on_chunk(текст) вызывается по мере генерации.
+    Ошибки запроса и пустой ответ не скрываются: задача, которая ждет ответа, повторится.
+    """
+    if cache_scope is not None:
+        cache_key = AnswerCache.make_key(input_str, cache_scope)
+        if (cached := await answer_cache.get(cache_key)) is not None:
+            return cached
 
-def chat_gpt_query(input_str):
-    """Выполняет запрос к ChatGPT и обрабатывает ответ"""
     dialog_data = [
         {"role": "system", "content": prompts["start_prompt"]},
         {"role": "user", "content": input_str}
     ]
 
-    try:
-        response = ask_gpt(dialog_data)
+    if on_chunk is not None:
+        answer = await ask_gpt_stream(dialog_data, on_chunk)
+    else:
+        response = await ask_gpt(dialog_data)
         # Получаем текст ответа напрямую из response
         if isinstance(response, dict):
-            return response.get('content', '')
-        return str(response)
-
-    except Exception as e:
-        print(f"Error in chat_gpt_query: {e}")
-        return None
+            answer = response.get('content', '')
+        else:
+            answer = str(response)
+    if not answer:
+        raise ValueError("LLM returned an empty answer")
+    if cache_scope is not None:
+        await answer_cache.set(cache_key, answer)
+    return answer
 
 
-def ask_gpt(context):
-    """Выполняет запрос к API ChatGPT"""
-    response = openai.ChatCompletion.create(
+def _create_completion(context, **kwargs):
+    openai.aiosession.set(_get_session())
+    return openai.ChatCompletion.acreate(
         model=os.getenv("gpt_model", "gpt-3.5-turbo"),
         messages=context,
         temperature=0.7,
         n=1,
         max_tokens=500,
-        headers={"Content-Type": "application/json; charset=utf-8"}
+        request_timeout=GPT_TIMEOUT,
+        headers={"Content-Type": "application/json; charset=utf-8"},
+        **kwargs
     )
-    return response.choices[0].message
+
+
+async def _retry_delay(attempt):
+    # Экспоненциальная задержка со случайным разбросом
+    await asyncio.sleep(GPT_RETRY_DELAY * 2 ** attempt + random.uniform(0, GPT_RETRY_DELAY))
+
+
+async def ask_gpt(context):
+    """Выполняет запрос к API ChatGPT, повторяя его при временных ошибках"""
+    with LLM_SECONDS.labels("plain").time():
+        for attempt in range(GPT_RETRIES + 1):
+            try:
+                async with _get_semaphore():
+                    response = await _create_completion(context)
+                if usage := response.get("usage"):
+                    LLM_TOKENS.labels("prompt").inc(usage.get("prompt_tokens", 0))
+                    LLM_TOKENS.labels("completion").inc(usage.get("completion_tokens", 0))
+                return response.choices[0].message
+            except Exception as err:
+                LLM_ERRORS.labels(type(err).__name__).inc()
+                if not isinstance(err, RETRY_ERRORS) or attempt == GPT_RETRIES:
+                    raise
+                await _retry_delay(attempt)
+
+
+async def ask_gpt_stream(context, on_chunk):
+    """Запрашивает ответ потоком: on_chunk получает накопленный текст после каждого фрагмента.
+    Повторяем запрос, только если пользователь еще не увидел ни одного фрагмента.
+    """
+    # В потоковом режиме API не сообщает расход токенов: промпт считаем сами, ответ — по фрагментам
+    LLM_TOKENS.labels("prompt").inc(sum(count_tokens(message["content"]) for message in context))
+    with LLM_SECONDS.labels("stream").time():
+        for attempt in range(GPT_RETRIES + 1):
+            answer = ""
+            try:
+                async with _get_semaphore():
+                    start = time.perf_counter()
+                    async for chunk in await _create_completion(context, stream=True):
+                        if delta := chunk.choices[0].delta.get("content"):
+                            if not answer:
+                                LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - start)
+                            LLM_TOKENS.labels("completion").inc()
+                            answer += delta
+                            await on_chunk(answer)
+                return answer
+            except Exception as err:
+                LLM_ERRORS.labels(type(err).__name__).inc()
+                if not isinstance(err, RETRY_ERRORS) or attempt == GPT_RETRIES or answer:
+                    raise
+                await _retry_delay(attempt)
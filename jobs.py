@@ -0,0 +1,393 @@
+import os
+import json
+import time
+import asyncio
+import multiprocessing
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from prometheus_client import start_http_server
+from sqlalchemy import select, insert, update, delete, func, and_, or_
+from sqlalchemy.orm import aliased
+
+import config  # noqa: F401 - загружает .env до чтения настроек
+import data_base.utils as db
+from data_base.engine import DB_SHARDS, engine, get_engine, remove_sessions, dispose_engines
+from data_base.models import Job
+from gpt_util import close_session
+from metrics import VOICE_STAGE_SECONDS, instrument_engine
+from outbox import QueuedBot
+from search import find_answer
+from streaming import StreamingReply
+from voice_util import ogg_to_pcm, transcribe, TranscodeError, RecognitionError
+
+# Очередь фоновых задач в SQLite: обработчики бота только ставят задачу и сразу отвечают,
+# распознавание голоса и поиск ответа выполняют отдельные процессы, результат они сами
+# отправляют в чат. Задача переживает перезапуск, а задачу упавшего воркера заберет другой.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+# Сколько задач один воркер выполняет одновременно
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", 4))
+# Сколько задач одного пользователя выполняется одновременно во всех воркерах
+JOB_USER_CONCURRENCY = int(os.getenv("JOB_USER_CONCURRENCY", 1))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 0.5))
+# Аренда задачи (сек): пока задача выполняется, воркер ее продлевает
+JOB_LEASE = float(os.getenv("JOB_LEASE", 120))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+# Задержка перед повтором удваивается с каждой попыткой
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", 5))
+# Сколько незавершенных задач может быть у одного пользователя
+JOB_USER_LIMIT = int(os.getenv("JOB_USER_LIMIT", 3))
+# Сколько хранить завершенные задачи (сек)
+JOB_KEEP = int(os.getenv("JOB_KEEP", 7 * 24 * 3600))
+# Метрики воркеров: JOB_METRICS_PORT + номер воркера, пустое значение отключает
+JOB_METRICS_PORT = os.getenv("JOB_METRICS_PORT", "9200")
+
+ACTIVE = ("queued", "running")
+STATUS_NAMES = {"queued": "в очереди", "running": "выполняется", "done": "готово", "failed": "ошибка"}
+KIND_NAMES = {"search": "поиск", "voice": "голосовое"}
+
+FAIL_TEXT = "🔄 Давайте попробуем переформулировать вопрос"
+
+
+class JobLimitExceeded(Exception):
+    pass
+
+
+async def enqueue(kind, user_id, chat_id, payload):
+    """Ставит задачу в очередь и возвращает ее id"""
+    user_id, now = str(user_id), time.time()
+    async with engine.begin() as conn:
+        active = await conn.scalar(select(func.count()).select_from(Job)
+                                   .where(Job.user_id == user_id, Job.status.in_(ACTIVE)))
+        if active >= JOB_USER_LIMIT:
+            raise JobLimitExceeded
+        return await conn.scalar(insert(Job).values(
+            kind=kind, user_id=user_id, chat_id=str(chat_id), payload=json.dumps(payload, ensure_ascii=False),
+            status="queued", attempts=0, run_at=now, created_at=now, updated_at=now,
+        ).returning(Job.id))
+
+
+async def claim(worker):
+    """
+    Забирает одну готовую к выполнению задачу (или задачу с истекшей арендой) одним UPDATE.
+
+    Очередь общая для всех воркеров, поэтому лимит на пользователя действует во всех процессах:
+    задача пользователя, у которого уже выполняется JOB_USER_CONCURRENCY задач, ждет.
+    Первыми идут пользователи, у которых сейчас выполняется меньше задач, поэтому пользователи
+    обслуживаются по кругу и активный пользователь не задерживает остальных.
+    """
+    now = time.time()
+    running = aliased(Job)
+    user_running = (select(func.count()).select_from(running)
+                    .where(running.user_id == Job.user_id, running.status == "running", running.locked_until >= now)
+                    .scalar_subquery())
+    ready = (select(Job.id)
+             .where(or_(and_(Job.status == "queued", Job.run_at <= now),
+                        and_(Job.status == "running", Job.locked_until < now)),
+                    user_running < JOB_USER_CONCURRENCY)
+             .order_by(user_running, Job.run_at).limit(1).scalar_subquery())
+    async with engine.begin() as conn:
+        return (await conn.execute(
+            update(Job).where(Job.id == ready)
+            .values(status="running", attempts=Job.attempts + 1, locked_until=now + JOB_LEASE,
+                    worker=worker, updated_at=now)
+            .returning(Job.id, Job.kind, Job.user_id, Job.chat_id, Job.payload, Job.attempts, Job.result)
+        )).first()
+
+
+def _owned(job, worker):
+    # Если аренда истекла и задачу забрал другой воркер, результат этого воркера не записываем
+    return and_(Job.id == job.id, Job.worker == worker, Job.attempts == job.attempts, Job.status == "running")
+
+
+async def extend(job, worker):
+    async with engine.begin() as conn:
+        await conn.execute(update(Job).where(_owned(job, worker)).values(locked_until=time.time() + JOB_LEASE))
+
+
+async def save_result(job, worker, result):
+    """Записывает промежуточный результат, не завершая задачу"""
+    async with engine.begin() as conn:
+        await conn.execute(update(Job).where(_owned(job, worker)).values(
+            result=json.dumps(result, ensure_ascii=False), updated_at=time.time()))
+
+
+async def complete(job, worker, result=None):
+    async with engine.begin() as conn:
+        await conn.execute(update(Job).where(_owned(job, worker)).values(
+            status="done", locked_until=None, updated_at=time.time(),
+            result=json.dumps(result, ensure_ascii=False) if result is not None else None))
+
+
+async def fail(job, worker, error):
+    """Возвращает задачу в очередь с задержкой; после JOB_MAX_ATTEMPTS попыток помечает ее failed.
+    Возвращает True, если задача будет повторена.
+    """
+    now = time.time()
+    retry = job.attempts < JOB_MAX_ATTEMPTS
+    values = {"status": "queued", "run_at": now + JOB_RETRY_DELAY * 2 ** (job.attempts - 1)} if retry \
+        else {"status": "failed"}
+    async with engine.begin() as conn:
+        await conn.execute(update(Job).where(_owned(job, worker))
+                           .values(locked_until=None, error=error, updated_at=now, **values))
+    return retry
+
+
+async def cleanup():
+    """Удаляет завершенные задачи старше JOB_KEEP"""
+    async with engine.begin() as conn:
+        await conn.execute(delete(Job).where(Job.status.in_(("done", "failed")),
+                                             Job.updated_at < time.time() - JOB_KEEP))
+
+
+async def get_user_jobs(user_id, limit=10):
+    async with engine.connect() as conn:
+        return (await conn.execute(
+            select(Job.id, Job.kind, Job.status, Job.attempts, Job.created_at)
+            .where(Job.user_id == str(user_id)).order_by(Job.id.desc()).limit(limit)
+        )).all()
+
+
+async def get_queue_positions(user_id):
+    """
+    Места задач пользователя в очереди: {id задачи: позиция}, 1 — задачу возьмут следующей.
+    Впереди — задачи всех пользователей, поставленные раньше, и выполняющиеся задачи этого пользователя
+    (пока они не закончатся, claim() его задачи не берет).
+    """
+    user_id, now = str(user_id), time.time()
+    other = aliased(Job)
+    ahead = (select(func.count()).select_from(other)
+             .where(other.status == "queued",
+                    or_(other.run_at < Job.run_at, and_(other.run_at == Job.run_at, other.id < Job.id)))
+             .scalar_subquery())
+    running = (select(func.count()).select_from(other)
+               .where(other.user_id == user_id, other.status == "running", other.locked_until >= now)
+               .scalar_subquery())
+    async with engine.connect() as conn:
+        rows = (await conn.execute(select(Job.id, ahead + running + 1)
+                                   .where(Job.user_id == user_id, Job.status == "queued"))).all()
+    return dict(rows)
+
+
+async def get_job_result(user_id, job_id):
+    """Результат задачи пользователя (ответ сохраняется до того, как показана кнопка) или {}"""
+    async with engine.connect() as conn:
+        result = await conn.scalar(select(Job.result).where(Job.id == job_id, Job.user_id == str(user_id)))
+    return json.loads(result) if result else {}
+
+
+class Progress:
+    """
+    Выполненные шаги задачи, они хранятся в ее результате.
+
+    Повтор после ошибки пропускает шаги, сделанные прошлыми попытками: знание не создается дважды,
+    а пользователь не получает те же сообщения снова. Шаг отмечается сразу после выполнения,
+    до следующего сообщения пользователю.
+    """
+
+    def __init__(self, job, worker):
+        self.job = job
+        self.worker = worker
+        self.data = json.loads(job.result) if job.result else {}
+
+    async def save(self, **values):
+        self.data.update(values)
+        await save_result(self.job, self.worker, self.data)
+
+    async def once(self, step, action):
+        """Выполняет action() только в первой попытке, дошедшей до этого шага"""
+        if not self.data.get(step):
+            await action()
+            await self.save(**{step: True})
+
+
+def format_answer(answer, from_base, ai_title="🤖 Сгенерированный ответ"):
+    if from_base:
+        return f"📚 Ответ из базы знаний:\n\n{answer}"
+    return f"{ai_title}:\n\n{answer}"
+
+
+async def answer_question(bot, job, progress, question, ai_title="🤖 Сгенерированный ответ"):
+    # Ответ показывается по мере генерации в одном сообщении. Если ответ получен прошлой попыткой,
+    # он показывается новым сообщением без повторного запроса к LLM
+    reply = StreamingReply(bot, job.chat_id)
+    # Ошибка или пустой ответ LLM доходят до _execute исключением: задача повторится, а после последней
+    # попытки пользователь получит FAIL_TEXT. Поэтому ни ответ None, ни кнопка для него не сохраняются
+    if not progress.data.get("answer"):
+        try:
+            answer, from_base = await find_answer(job.user_id, question,
+                                                  lambda part, from_base: reply.update(format_answer(part, from_base,
+                                                                                                     ai_title)))
+        except Exception:
+            # Поток оборвался после первых фрагментов: показанная часть остается с пометкой,
+            # полный ответ придет новым сообщением при повторе задачи
+            await reply.interrupt()
+            raise
+        # Ответ ИИ можно сохранить в базу: кнопка ссылается на задачу, поэтому ответ записывается раньше кнопки
+        await progress.save(answer=answer, question=question, from_base=from_base)
+
+    if progress.data["from_base"]:
+        await progress.once("replied", lambda: reply.finish(format_answer(progress.data["answer"], True)))
+        return progress.data
+
+    kb = InlineKeyboardMarkup()
+    kb.add(InlineKeyboardButton("💾 Сохранить ответ в базу", callback_data=f"save_ai_response_{job.id}"))
+    await progress.once("replied", lambda: reply.finish(format_answer(progress.data["answer"], False, ai_title),
+                                                        reply_markup=kb))
+    return progress.data
+
+
+async def run_search(bot, job, progress, payload):
+    return await answer_question(bot, job, progress, payload["text"])
+
+
+async def recognize(bot, file_id):
+    with VOICE_STAGE_SECONDS.labels("download").time():
+        voice = await bot.get_file(file_id)
+        file = await bot.download_file(voice.file_path)
+    with VOICE_STAGE_SECONDS.labels("transcode").time():
+        pcm = await ogg_to_pcm(file.getvalue())
+    with VOICE_STAGE_SECONDS.labels("recognize").time():
+        return await transcribe(pcm)
+
+
+async def run_voice(bot, job, progress, payload):
+    if "text" not in progress.data:
+        try:
+            text = await recognize(bot, payload["file_id"])
+        except (TranscodeError, RecognitionError) as err:
+            # Повтор не поможет: сообщаем пользователю и завершаем задачу
+            print(f"От: {job.user_id}, голосовое сообщение\nОшибка: {err}")
+            await bot.send_message(job.chat_id, "🔇 Не удалось распознать голосовое сообщение, попробуйте еще раз")
+            return {"error": str(err)}
+        await progress.save(text=text)
+    text = progress.data["text"]
+
+    current_state = payload.get("state")
+    if current_state == "States:search":
+        await progress.once("recognized",
+                            lambda: bot.send_message(job.chat_id, f"Распознанный текст: {text}\nИщу..."))
+        with VOICE_STAGE_SECONDS.labels("search").time():
+            return await answer_question(bot, job, progress, text, "🤖 Вот что я знаю")
+
+    await progress.once("recognized", lambda: bot.send_message(job.chat_id, f"Распознанный текст: {text}"))
+    head_catalog_id = payload.get("head_catalog_id")
+
+    if current_state in ["States:add_catalog", "States:add_catalog_voice"]:
+        # Каталог создается один раз: повтор задачи после коммита его не дублирует
+        await progress.once("created", lambda: db.create_catalog(job.user_id, text, head_catalog_id or None))
+        success_message = f"✅ | Каталог '{text}' добавлен!"
+    elif head_catalog_id:
+        await progress.once("created", lambda: db.create_note(job.user_id, head_catalog_id, text))
+        success_message = f"✅ | Знание '{text}' добавлено!"
+    else:
+        await progress.once("replied", lambda: bot.send_message(
+            job.chat_id, f"🗄 | Знание '{text}' не может быть создано тут(\n"
+                         f"🗄 | Выберите Каталог и создайте знание в нем"))
+        return progress.data
+
+    exit_kb = InlineKeyboardMarkup().add(InlineKeyboardButton("⬅️", callback_data=payload.get("last_menu", "")))
+    await progress.once("replied", lambda: bot.send_message(job.chat_id, success_message, reply_markup=exit_kb))
+    return progress.data
+
+
+HANDLERS = {
+    "search": run_search,
+    "voice": run_voice,
+}
+
+
+async def _heartbeat(job, worker):
+    while True:
+        await asyncio.sleep(JOB_LEASE / 3)
+        await extend(job, worker)
+
+
+async def _execute(bot, job, worker, semaphore):
+    heartbeat = asyncio.create_task(_heartbeat(job, worker))
+    try:
+        result = await HANDLERS[job.kind](bot, job, Progress(job, worker), json.loads(job.payload))
+        await complete(job, worker, result)
+    except Exception as err:
+        print(f"Задача #{job.id} ({job.kind}), попытка {job.attempts}\nОшибка: {err!r}")
+        if not await fail(job, worker, repr(err)):
+            try:
+                await bot.send_message(job.chat_id, FAIL_TEXT)
+            except Exception as send_err:
+                print(f"Задача #{job.id}: не удалось сообщить об ошибке: {send_err}")
+    finally:
+        heartbeat.cancel()
+        await remove_sessions()
+        semaphore.release()
+
+
+async def work(index):
+    """Цикл воркера: забирает задачи из очереди и выполняет до JOB_CONCURRENCY одновременно"""
+    worker = f"{os.getpid()}-{index}"
+    if JOB_METRICS_PORT:
+        start_http_server(int(JOB_METRICS_PORT) + index)
+    for shard in range(DB_SHARDS):
+        instrument_engine(get_engine(shard))
+
+    bot = QueuedBot(token=os.getenv("TOKEN"))
+    semaphore = asyncio.Semaphore(JOB_CONCURRENCY)
+    tasks = set()
+    cleaned_at = 0
+    try:
+        while True:
+            await semaphore.acquire()
+            try:
+                job = await claim(worker)
+            except Exception as err:
+                print(f"Не удалось взять задачу из очереди: {err}")
+                job = None
+            if job is None:
+                semaphore.release()
+                if time.time() - cleaned_at > 3600:
+                    try:
+                        await cleanup()
+                    except Exception as err:
+                        print(f"Не удалось удалить старые задачи: {err}")
+                    cleaned_at = time.time()
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+                continue
+
+            task = asyncio.create_task(_execute(bot, job, worker, semaphore))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        # Незавершенные задачи вернутся в очередь, когда истечет их аренда
+        for task in tasks:
+            task.cancel()
+        await (await bot.get_session()).close()
+        await close_session()
+        await dispose_engines()
+
+
+def run_worker(index):
+    asyncio.run(work(index))
+
+
+def start_workers(count=JOB_WORKERS):
+    """Запускает процессы-воркеры очереди задач"""
+    context = multiprocessing.get_context("spawn")
+    # Не daemon: воркерам может понадобиться свой пул процессов (распознавание речи)
+    workers = [context.Process(target=run_worker, args=(index,)) for index in range(count)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def stop_workers(workers):
+    for worker in workers:
+        worker.terminate()
+        worker.join()
+
+
+if __name__ == '__main__':
+    # Воркеры можно запускать отдельно от бота: python jobs.py
+    processes = start_workers()
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        stop_workers(processes)
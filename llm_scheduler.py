@@ -0,0 +1,22 @@
+import asyncio
+
+from gpt_util import AnswerCache, chat_gpt_query, get_cached_answer
+
+# Запросы к LLM выполняют воркеры очереди задач. Сколько задач идет одновременно и сколько из них
+# у одного пользователя, решает claim() в jobs.py сразу для всех процессов, а число запросов
+# одного процесса к LLM ограничивает GPT_CONCURRENCY в gpt_util. Здесь остается склейка
+# одинаковых запросов: пока первый выполняется, такой же запрос повторно не отправляется.
+_inflight = {}
+
+
+async def scheduled_query(input_str, cache_scope=None, on_chunk=None):
+    """chat_gpt_query с кэшем и склейкой одинаковых запросов; ответ из кэша возвращается без ожидания.
+    Потоковый ответ (on_chunk) видит только тот, чей запрос ушел в LLM, остальные получают итог.
+    """
+    if cache_scope is not None and (cached := await get_cached_answer(input_str, cache_scope)) is not None:
+        return cached
+    key = AnswerCache.make_key(input_str, cache_scope)
+    if key not in _inflight:
+        _inflight[key] = asyncio.ensure_future(chat_gpt_query(input_str, cache_scope, on_chunk))
+        _inflight[key].add_done_callback(lambda _: _inflight.pop(key, None))
+    return await asyncio.shield(_inflight[key])
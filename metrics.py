@@ -0,0 +1,63 @@
+import os
+import time
+import contextvars
+
+from prometheus_client import Counter, Histogram, start_http_server
+from sqlalchemy import event
+
+# Порт HTTP-эндпоинта /metrics в формате Prometheus; пустое значение — не запускать
+METRICS_PORT = os.getenv("METRICS_PORT", "9100")
+
+# Границы корзин: от миллисекунд для SQL до минуты для LLM и распознавания речи
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время обработчика апдейта",
+                            ["kind", "handler", "state"], buckets=SLOW_BUCKETS)
+UPDATE_DB_QUERIES = Histogram("bot_update_db_queries", "SQL-запросов на один апдейт",
+                              buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+UPDATE_DB_SECONDS = Histogram("bot_update_db_seconds", "Суммарное время SQL-запросов на один апдейт",
+                              buckets=FAST_BUCKETS)
+DB_QUERY_SECONDS = Histogram("db_query_seconds", "Время одного SQL-запроса", ["statement"], buckets=FAST_BUCKETS)
+
+LLM_SECONDS = Histogram("llm_request_seconds", "Время запроса к LLM (с повторами)", ["mode"], buckets=SLOW_BUCKETS)
+LLM_FIRST_TOKEN_SECONDS = Histogram("llm_first_token_seconds", "Время до первого фрагмента потокового ответа",
+                                    buckets=SLOW_BUCKETS)
+LLM_TOKENS = Counter("llm_tokens", "Токены LLM", ["kind"])
+LLM_ERRORS = Counter("llm_errors", "Ошибки запросов к LLM", ["error"])
+LLM_CACHE = Counter("llm_cache_lookups", "Обращения к кэшу ответов LLM", ["result"])
+
+SEARCH_STAGE_SECONDS = Histogram("search_stage_seconds", "Этапы поиска ответа", ["stage"], buckets=SLOW_BUCKETS)
+VOICE_STAGE_SECONDS = Histogram("voice_stage_seconds", "Этапы обработки голосового сообщения", ["stage"],
+                                buckets=SLOW_BUCKETS)
+
+
+class UpdateStats:
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+# Счетчики текущего апдейта; задаются в middleware и видны SQL-событиям той же задачи
+update_stats = contextvars.ContextVar("update_stats", default=None)
+
+
+def instrument_engine(engine):
+    """Подписывается на события движка: время каждого запроса и счетчики текущего апдейта"""
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        DB_QUERY_SECONDS.labels(statement.lstrip().split(" ", 1)[0].upper()).observe(elapsed)
+        if (stats := update_stats.get()) is not None:
+            stats.queries += 1
+            stats.db_seconds += elapsed
+
+
+def start_metrics_server():
+    if METRICS_PORT:
+        start_http_server(int(METRICS_PORT))
@@ -0,0 +1,49 @@
+import re
+import time
+
+from aiogram import types
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from data_base.engine import remove_sessions
+from metrics import HANDLER_SECONDS, UPDATE_DB_QUERIES, UPDATE_DB_SECONDS, UpdateStats, update_stats
+
+
+class DatabaseMiddleware(BaseMiddleware):
+    """Закрывает сессии БД (во всех шардах), которые открыл обработчик апдейта"""
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        await remove_sessions()
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Время обработчиков сообщений и кнопок, число и время SQL-запросов на апдейт"""
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        update_stats.set(UpdateStats())
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        if (stats := update_stats.get()) is not None:
+            UPDATE_DB_QUERIES.observe(stats.queries)
+            UPDATE_DB_SECONDS.observe(stats.db_seconds)
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        data["metrics_handler"] = current_handler.get().__name__
+        data["metrics_start"] = time.perf_counter()
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        self._observe("message", data.get("metrics_handler"), data)
+
+    async def on_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        # Кнопки различаем по префиксу callback_data без id и курсора: list_catalog_, del_note_ ...
+        data["metrics_handler"] = re.match(r"[a-z_]*", callback_query.data or "").group() or "other"
+        data["metrics_start"] = time.perf_counter()
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, results, data: dict):
+        self._observe("callback", data.get("metrics_handler"), data)
+
+    @staticmethod
+    def _observe(kind, handler, data):
+        if handler is not None:
+            HANDLER_SECONDS.labels(kind, handler, data.get("raw_state") or "") \
+                .observe(time.perf_counter() - data["metrics_start"])
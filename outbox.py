@@ -0,0 +1,149 @@
+import os
+import time
+import asyncio
+
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter
+
+# Лимиты Bot API: около 30 сообщений в секунду всего, 1 в секунду в личный чат и 20 в минуту в группу.
+# Лимиты считаются в памяти процесса. Если сообщения отправляют несколько процессов (воркеры вебхука,
+# воркеры очереди задач), общий предел — число процессов × OUTBOX_GLOBAL_RATE, а сообщения в один чат
+# из разных процессов (подтверждение от бота и ответ от воркера задач) ограничиваются раздельно.
+# В таком режиме OUTBOX_GLOBAL_RATE стоит уменьшить до 30 / число процессов
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", 30))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", 1))
+OUTBOX_CHAT_BURST = int(os.getenv("OUTBOX_CHAT_BURST", 3))
+OUTBOX_GROUP_RATE = float(os.getenv("OUTBOX_GROUP_RATE", 20 / 60))
+# Сколько раз повторять запрос после RetryAfter
+OUTBOX_RETRIES = int(os.getenv("OUTBOX_RETRIES", 5))
+# Сколько секунд хранить лимиты чата, в который ничего не отправляли
+OUTBOX_CHAT_IDLE = 60
+
+
+class TokenBucket:
+    """Ограничитель частоты: не больше rate запросов в секунду с запасом burst.
+    Ожидающие получают разрешение в порядке очереди."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+    def pause(self, seconds):
+        """Запрещает запросы на seconds секунд (после RetryAfter от Telegram)"""
+        self._refill()
+        # Следующему запросу не хватит ровно seconds * rate токенов до единицы
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.burst and not self._lock.locked()
+
+
+class QueuedBot(Bot):
+    """
+    Bot, который отправляет сообщения через очередь с учетом лимитов Telegram.
+
+    Запросы в один чат выполняются по порядку и не чаще лимита чата, все вместе — не чаще глобального.
+    На RetryAfter чат ставится на паузу, и запрос повторяется. Если правка текста сообщения
+    еще ждет очереди, а следом пришла новая правка того же сообщения, отправляется только новая.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._global = TokenBucket(OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_RATE)
+        self._chats = {}
+        self._chat_locks = {}
+        self._edits = {}
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        chat_id = (data or {}).get("chat_id")
+        if chat_id is None:
+            return await super().request(method, data, files, **kwargs)
+
+        chat_id = str(chat_id)
+        edit_key = (chat_id, str(data["message_id"])) if method == "editMessageText" and "message_id" in data else None
+        if edit_key is not None:
+            future = asyncio.get_running_loop().create_future()
+            self._edits[edit_key] = future
+
+        try:
+            async with self._chat_lock(chat_id):
+                newer = self._edits.get(edit_key) if edit_key is not None else None
+                if newer is None or newer is future:
+                    result = await self._send(chat_id, method, data, files, **kwargs)
+            if newer is not None and newer is not future:
+                # Пока ждали, пришла правка новее: показывать этот текст уже незачем, ждем ее результата
+                try:
+                    result = await asyncio.shield(newer)
+                except asyncio.CancelledError:
+                    if not newer.cancelled():
+                        raise
+                    # Новую правку отменили — отправляем свою
+                    async with self._chat_lock(chat_id):
+                        result = await self._send(chat_id, method, data, files, **kwargs)
+        except BaseException as err:
+            if edit_key is not None:
+                self._finish_edit(edit_key, future, error=err)
+            raise
+        if edit_key is not None:
+            self._finish_edit(edit_key, future, result=result)
+        return result
+
+    def _chat_lock(self, chat_id):
+        if chat_id not in self._chat_locks:
+            if len(self._chat_locks) >= 1000:
+                self._forget_idle_chats()
+            self._chat_locks[chat_id] = asyncio.Lock()
+            # Личные чаты (id > 0) и группы (id < 0) ограничены по-разному
+            self._chats[chat_id] = TokenBucket(OUTBOX_GROUP_RATE) if chat_id.startswith("-") \
+                else TokenBucket(OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST)
+        return self._chat_locks[chat_id]
+
+    def _forget_idle_chats(self):
+        now = time.monotonic()
+        for chat_id in [chat_id for chat_id, bucket in self._chats.items()
+                        if now - bucket.updated > OUTBOX_CHAT_IDLE and bucket.idle()
+                        and not self._chat_locks[chat_id].locked()]:
+            del self._chats[chat_id], self._chat_locks[chat_id]
+
+    async def _send(self, chat_id, method, data, files, **kwargs):
+        bucket = self._chats[chat_id]
+        for attempt in range(OUTBOX_RETRIES + 1):
+            await bucket.acquire()
+            await self._global.acquire()
+            try:
+                return await super().request(method, data, files, **kwargs)
+            except RetryAfter as err:
+                if attempt == OUTBOX_RETRIES:
+                    raise
+                print(f"Flood control in chat {chat_id}, retry in {err.timeout} s")
+                bucket.pause(err.timeout)
+
+    def _finish_edit(self, key, future, result=None, error=None):
+        if not future.done():
+            if error is not None and not isinstance(error, asyncio.CancelledError):
+                future.set_exception(error)
+                # Исключение мог никто не ждать, не пишем об этом в лог
+                future.exception()
+            elif error is not None:
+                future.cancel()
+            else:
+                future.set_result(result)
+        if self._edits.get(key) is future:
+            del self._edits[key]
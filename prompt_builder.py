@@ -0,0 +1,115 @@
+import os
+import math
+from collections import defaultdict
+
+from data_base.retrieval import tokenize
+
+# Бюджеты промптов в токенах: дерево каталогов, все знания вместе и одно знание
+PROMPT_TREE_TOKENS = int(os.getenv("PROMPT_TREE_TOKENS", 1500))
+PROMPT_TREE_DEPTH = int(os.getenv("PROMPT_TREE_DEPTH", 4))
+PROMPT_NOTES_TOKENS = int(os.getenv("PROMPT_NOTES_TOKENS", 2000))
+PROMPT_NOTE_TOKENS = int(os.getenv("PROMPT_NOTE_TOKENS", 400))
+# Без tiktoken считаем грубо: кириллица занимает примерно токен на 3 символа
+CHARS_PER_TOKEN = 3
+
+# None — tiktoken еще не загружали, False — он не установлен
+_encoding = None
+
+
+def _get_encoding():
+    """Кодировка tiktoken для модели; загружается при первом подсчете, а не при старте"""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+        except ImportError:
+            _encoding = False
+            return _encoding
+        try:
+            _encoding = tiktoken.encoding_for_model(os.getenv("gpt_model", "gpt-3.5-turbo"))
+        except KeyError:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+    return _encoding
+
+
+def count_tokens(text):
+    if not (encoding := _get_encoding()):
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text))
+
+
+def truncate(text, tokens):
+    """Обрезает текст до tokens токенов, отмечая обрезку многоточием"""
+    if count_tokens(text) <= tokens:
+        return text
+    if not (encoding := _get_encoding()):
+        return text[:tokens * CHARS_PER_TOKEN].rstrip() + "…"
+    return encoding.decode(encoding.encode(text)[:tokens]).rstrip() + "…"
+
+
+def build_tree(rows, budget=PROMPT_TREE_TOKENS, max_depth=PROMPT_TREE_DEPTH):
+    """
+    Дерево каталогов для промпта в пределах budget токенов.
+
+    Каталоги добавляются по уровням, начиная с корня, пока хватает бюджета и глубины.
+    У каталога со скрытыми подкаталогами пишется их число: "Работа/ (+12)".
+    rows — строки (id, parent, value), как из get_catalog_rows.
+    """
+    childs = defaultdict(list)
+    for row in rows:
+        childs[row.parent].append(row)
+
+    # Размер поддерева каждого каталога: проходим уровни от листьев к корню
+    order, level = [], childs[None]
+    while level:
+        order.extend(level)
+        level = [child for row in level for child in childs[row.id]]
+    sizes = {}
+    for row in reversed(order):
+        sizes[row.id] = 1 + sum(sizes[child.id] for child in childs[row.id])
+
+    shown, used, full = set(), 0, False
+    level, depth = childs[None], 1
+    while level and depth <= max_depth and not full:
+        next_level = []
+        for row in level:
+            cost = count_tokens(f'{" " * 2 * depth}{row.value}/ (+0)\n')
+            if used + cost > budget:
+                full = True
+                break
+            shown.add(row.id)
+            used += cost
+            next_level.extend(childs[row.id])
+        level, depth = next_level, depth + 1
+
+    data = []
+    stack = [(row, 2) for row in reversed(childs[None]) if row.id in shown]
+    while stack:
+        row, indent = stack.pop()
+        hidden = sum(sizes[child.id] for child in childs[row.id] if child.id not in shown)
+        data.append(f'{" " * indent}{row.value}{"/" if childs[row.id] else ""}'
+                    f'{f" (+{hidden})" if hidden else ""}\n')
+        stack.extend((child, indent + 2) for child in reversed(childs[row.id]) if child.id in shown)
+
+    if hidden_roots := sum(sizes[row.id] for row in childs[None] if row.id not in shown):
+        data.append(f"  … (+{hidden_roots})\n")
+    return "".join(data)
+
+
+def rank_notes(question, notes):
+    """Сортирует знания по числу слов вопроса в них; при равенстве сохраняется исходный порядок"""
+    words = set(tokenize(question))
+    return sorted(notes, key=lambda note: -len(words.intersection(tokenize(note["value"]))))
+
+
+def build_notes(question, notes, budget=PROMPT_NOTES_TOKENS, note_budget=PROMPT_NOTE_TOKENS):
+    """Знания для промпта read_file: самые подходящие первыми, каждое обрезано, всего не больше budget токенов"""
+    lines, used = [], 0
+    for note in rank_notes(question, notes):
+        line = f"- {truncate(note['value'].strip(), note_budget)}\n"
+        cost = count_tokens(line)
+        if used + cost > budget:
+            break
+        lines.append(line)
+        used += cost
+    return "".join(lines)
@@ -0,0 +1,37 @@
+import data_base.utils as db
+import prompt_builder
+from config import prompts
+from llm_scheduler import scheduled_query
+from metrics import SEARCH_STAGE_SECONDS
+
+
+async def find_answer(user_id, question, on_chunk=None):
+    """Ищет ответ на вопрос пользователя, возвращает (ответ, найден ли он в базе знаний)
+
+    Сначала знания подбираются локальным индексом, и тогда нужен один запрос к LLM.
+    Если похожих знаний нет, LLM выбирает каталог по дереву, как раньше.
+    Дерево и знания урезаются до бюджетов prompt_builder, чтобы промпт не рос вместе с базой.
+    on_chunk(текст, найден ли ответ в базе) получает итоговый ответ по мере генерации.
+    """
+    # Версия базы знаний входит в ключ кэша, поэтому после правок старые ответы не вернутся
+    version = await db.get_kb_version(user_id)
+    scope = f"{user_id}:{version}"
+    with SEARCH_STAGE_SECONDS.labels("retrieval").time():
+        notes = await db.get_relevant_notes(user_id, question, version=version)
+
+    if not notes:
+        with SEARCH_STAGE_SECONDS.labels("tree").time():
+            tree = prompt_builder.build_tree(await db.get_catalog_rows(user_id))
+        with SEARCH_STAGE_SECONDS.labels("location").time():
+            location = await scheduled_query(prompts["ask_file_location"].format(question, tree), scope)
+            if location:
+                notes = await db.get_notes_from_location(user_id, location)
+
+    from_base = bool(notes)
+    stream = (lambda text: on_chunk(text, from_base)) if on_chunk else None
+    if from_base:
+        prompt = prompts["read_file"].format(question, prompt_builder.build_notes(question, notes))
+    else:
+        prompt = prompts["generate_answer"].format(question)
+    with SEARCH_STAGE_SECONDS.labels("answer").time():
+        return await scheduled_query(prompt, scope, stream), from_base
@@ -0,0 +1,80 @@
+import os
+import time
+import asyncio
+
+from aiogram.utils.exceptions import MessageNotModified, RetryAfter, TelegramAPIError
+
+# Не чаще одной правки сообщения за столько секунд (лимиты Telegram на редактирование)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.5))
+MESSAGE_LIMIT = 4096
+CURSOR = " ▌"
+INTERRUPTED = "\n\n⚠️ Ответ прерван"
+
+
+class StreamingReply:
+    """
+    Ответ, который дописывается в одном сообщении по мере генерации.
+
+    Первый фрагмент отправляется сразу, дальше сообщение правится не чаще раза в interval секунд.
+    Правки идут в фоне, поэтому медленный Telegram не задерживает чтение потока от LLM.
+    """
+
+    def __init__(self, bot, chat_id, interval=STREAM_EDIT_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.interval = interval
+        self.message = None
+        self.text = ""
+        self._next_edit = 0
+        self._task = None
+
+    async def update(self, text):
+        self.text = text
+        if self._task is not None and not self._task.done() or time.monotonic() < self._next_edit:
+            return
+        self._next_edit = time.monotonic() + self.interval
+        self._task = asyncio.create_task(self._show(text[:MESSAGE_LIMIT - len(CURSOR)] + CURSOR))
+
+    async def finish(self, text, reply_markup=None):
+        """Показывает итоговый текст (с клавиатурой) и возвращает сообщение"""
+        if self._task is not None:
+            await self._task
+        if self.message is None:
+            self.message = await self.bot.send_message(self.chat_id, text, reply_markup=reply_markup,
+                                                       parse_mode=None)
+            return self.message
+
+        while True:
+            try:
+                await self.bot.edit_message_text(text, self.chat_id, self.message.message_id,
+                                                 reply_markup=reply_markup, parse_mode=None)
+            except MessageNotModified:
+                pass
+            except RetryAfter as err:
+                await asyncio.sleep(err.timeout)
+                continue
+            return self.message
+
+    async def interrupt(self):
+        """Помечает уже показанную часть ответа как прерванную, если генерация оборвалась"""
+        if self._task is not None:
+            await self._task
+        if self.message is None:
+            return
+        text = self.text[:MESSAGE_LIMIT - len(INTERRUPTED)] + INTERRUPTED
+        try:
+            await self.bot.edit_message_text(text, self.chat_id, self.message.message_id, parse_mode=None)
+        except TelegramAPIError as err:
+            print(f"Не удалось обновить сообщение {self.chat_id}: {err}")
+
+    async def _show(self, text):
+        try:
+            if self.message is None:
+                self.message = await self.bot.send_message(self.chat_id, text, parse_mode=None)
+            else:
+                await self.bot.edit_message_text(text, self.chat_id, self.message.message_id, parse_mode=None)
+        except RetryAfter as err:
+            self._next_edit = time.monotonic() + err.timeout
+        except TelegramAPIError as err:
+            # Промежуточная правка не важна: итоговый текст все равно покажет finish
+            print(f"Не удалось обновить сообщение {self.chat_id}: {err}")
@@ -0,0 +1,133 @@
+import os
+import json
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+# Формат, в который перекодируются голосовые: 16 кГц, моно, 16 бит
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+
+FFMPEG_CONCURRENCY = int(os.getenv("FFMPEG_CONCURRENCY", 4))
+FFMPEG_TIMEOUT = float(os.getenv("FFMPEG_TIMEOUT", 60))
+
+# Движок распознавания: google (онлайн) или vosk (офлайн, модель в VOSK_MODEL_PATH)
+SPEECH_BACKEND = os.getenv("SPEECH_BACKEND", "google")
+SPEECH_LANGUAGE = os.getenv("SPEECH_LANGUAGE", "ru-RU")
+SPEECH_WORKERS = int(os.getenv("SPEECH_WORKERS", os.cpu_count() or 1))
+VOSK_MODEL_PATH = os.getenv("VOSK_MODEL_PATH", "models/vosk-model-small-ru")
+
+_semaphore = None
+_backend = None
+# Модель Vosk, загружается один раз в каждом процессе пула
+_vosk_model = None
+
+
+class TranscodeError(Exception):
+    pass
+
+
+class RecognitionError(Exception):
+    pass
+
+
+def _get_semaphore():
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(FFMPEG_CONCURRENCY)
+    return _semaphore
+
+
+async def ogg_to_pcm(data):
+    """Перекодирует голосовое сообщение в сырой PCM через stdin/stdout ffmpeg, без временных файлов"""
+    from imageio_ffmpeg import get_ffmpeg_exe
+
+    async with _get_semaphore():
+        process = await asyncio.create_subprocess_exec(
+            get_ffmpeg_exe(), "-loglevel", "error", "-i", "pipe:0",
+            "-f", "s16le", "-acodec", "pcm_s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1",
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(data), FFMPEG_TIMEOUT)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise TranscodeError("ffmpeg timed out")
+
+    if process.returncode:
+        raise TranscodeError(stderr.decode(errors="ignore"))
+    return stdout
+
+
+class SpeechBackend:
+    """Движок распознавания речи: принимает PCM в формате SAMPLE_RATE/SAMPLE_WIDTH, возвращает текст"""
+
+    async def transcribe(self, pcm):
+        raise NotImplementedError
+
+
+class GoogleBackend(SpeechBackend):
+    def __init__(self, language=SPEECH_LANGUAGE):
+        self.language = language
+
+    def _recognize(self, pcm):
+        import speech_recognition as sr
+
+        try:
+            return sr.Recognizer().recognize_google(sr.AudioData(pcm, SAMPLE_RATE, SAMPLE_WIDTH),
+                                                    language=self.language)
+        except sr.UnknownValueError:
+            raise RecognitionError("speech was not recognized")
+
+    async def transcribe(self, pcm):
+        # Сетевой вызов библиотеки блокирующий, поэтому выполняем его в потоке
+        return await asyncio.to_thread(self._recognize, pcm)
+
+
+def _init_vosk(model_path):
+    global _vosk_model
+    from vosk import Model, SetLogLevel
+
+    SetLogLevel(-1)
+    _vosk_model = Model(model_path)
+
+
+def _vosk_recognize(pcm):
+    from vosk import KaldiRecognizer
+
+    recognizer = KaldiRecognizer(_vosk_model, SAMPLE_RATE)
+    recognizer.AcceptWaveform(pcm)
+    return json.loads(recognizer.FinalResult()).get("text", "")
+
+
+class VoskBackend(SpeechBackend):
+    def __init__(self, model_path=VOSK_MODEL_PATH, workers=SPEECH_WORKERS):
+        import vosk  # noqa: F401 - проверяем, что пакет установлен, до запуска пула
+
+        if not os.path.isdir(model_path):
+            raise RuntimeError(f"Vosk model not found: {model_path}")
+        self.pool = ProcessPoolExecutor(workers, initializer=_init_vosk, initargs=(model_path,))
+
+    async def transcribe(self, pcm):
+        text = await asyncio.get_running_loop().run_in_executor(self.pool, _vosk_recognize, pcm)
+        if not text:
+            raise RecognitionError("speech was not recognized")
+        return text
+
+
+BACKENDS = {
+    "google": GoogleBackend,
+    "vosk": VoskBackend,
+}
+
+
+def get_backend():
+    """Создает движок распознавания из SPEECH_BACKEND при первом обращении"""
+    global _backend
+    if _backend is None:
+        _backend = BACKENDS[SPEECH_BACKEND]()
+    return _backend
+
+
+async def transcribe(pcm):
+    return await get_backend().transcribe(pcm)
@@ -0,0 +1,113 @@
+import os
+import json
+import asyncio
+import weakref
+import multiprocessing
+
+import aiohttp
+from aiohttp import web
+from aiogram import Bot
+from aiogram.utils import executor
+
+import config  # noqa: F401 - загружает .env до чтения настроек
+
+# Запуск в режиме вебхука: главный процесс принимает апдейты от Telegram и передает
+# каждый в один из WEBHOOK_WORKERS процессов с ботом. Воркер выбирается по id
+# пользователя, поэтому апдейты одного пользователя обрабатываются по порядку
+# одним процессом, и его FSM-состояние не расходится между процессами.
+# Для разработки по-прежнему можно запускать polling: python bot.py
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", 8080))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", os.cpu_count() or 1))
+# Воркеры слушают 127.0.0.1 на портах WORKER_BASE_PORT, WORKER_BASE_PORT + 1, ...
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", 8100))
+
+
+def update_user_id(update):
+    """Id пользователя, от которого пришел апдейт (для апдейтов без пользователя — id апдейта)"""
+    for value in update.values():
+        if isinstance(value, dict) and isinstance(value.get("from"), dict):
+            return value["from"]["id"]
+    return update.get("update_id", 0)
+
+
+def worker_for(user_id, workers=WEBHOOK_WORKERS):
+    return user_id % workers
+
+
+def run_worker(index):
+    """Процесс-воркер: обычный aiogram-вебхук на локальном порту"""
+    # У каждого воркера свои метрики, поэтому и свой порт: METRICS_PORT + номер воркера
+    if metrics_port := os.getenv("METRICS_PORT", "9100"):
+        os.environ["METRICS_PORT"] = str(int(metrics_port) + index)
+    import bot
+
+    executor.start_webhook(dispatcher=bot.dp, webhook_path=WEBHOOK_PATH, on_startup=bot.on_startup,
+                           on_shutdown=bot.on_shutdown, host="127.0.0.1", port=WORKER_BASE_PORT + index)
+
+
+async def proxy_update(request):
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=403)
+
+    body = await request.read()
+    user_id = update_user_id(json.loads(body))
+    url = f"http://127.0.0.1:{WORKER_BASE_PORT + worker_for(user_id)}{WEBHOOK_PATH}"
+
+    # Следующий апдейт пользователя уходит воркеру только после ответа на предыдущий
+    locks = request.app["user_locks"]
+    lock = locks.get(user_id) or locks.setdefault(user_id, asyncio.Lock())
+    async with lock:
+        try:
+            async with request.app["client"].post(url, data=body,
+                                                  headers={"Content-Type": "application/json"}) as resp:
+                return web.Response(body=await resp.read(), status=resp.status, content_type=resp.content_type)
+        except aiohttp.ClientError as err:
+            # Воркер еще не поднялся или упал: Telegram повторит доставку апдейта
+            print(f"Worker for user {user_id} is unavailable: {err}")
+            return web.Response(status=503)
+
+
+async def on_startup(app):
+    app["client"] = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+    app["user_locks"] = weakref.WeakValueDictionary()
+    if WEBHOOK_HOST:
+        bot = Bot(token=os.getenv("TOKEN"))
+        await bot.set_webhook(WEBHOOK_HOST + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+        await bot.session.close()
+
+
+async def on_cleanup(app):
+    await app["client"].close()
+
+
+def main():
+    context = multiprocessing.get_context("spawn")
+    # Воркеры бота только ставят задачи в очередь и своих процессов не создают (распознавание речи
+    # с пулом процессов — в воркерах задач), поэтому они daemon и не переживут прокси
+    workers = [context.Process(target=run_worker, args=(index,), daemon=True) for index in range(WEBHOOK_WORKERS)]
+    for worker in workers:
+        worker.start()
+
+    # Голос и поиск выполняют воркеры очереди задач, их запускаем рядом с воркерами бота
+    from jobs import start_workers, stop_workers
+    job_workers = start_workers()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, proxy_update)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    try:
+        web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT)
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+        stop_workers(job_workers)
+
+
+if __name__ == '__main__':
+    main()